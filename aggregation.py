@@ -0,0 +1,76 @@
+# Per-group summaries of the predicted and calculated WQI, e.g. per Location and Period, for reporting.
+# The rows are sorted once by (group, value), then the count, mean, min, max, percentiles and VN quality-class counts
+# of every group are read off the sorted values without a Python loop over the groups.
+import numpy as np
+from utils import VN_WQI_class_names, get_VN_WQI_class
+
+summary_percentiles = [5, 25, 50, 75, 95]
+
+
+def get_group_codes(keys, group_by):
+    # Group number of every row and the key columns of each group, groups are sorted by their keys, missing keys form their own group
+    grouped = keys.groupby(group_by, sort=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+    group_keys = grouped.size().index.to_frame(index=False)
+    return codes, group_keys
+
+
+def get_group_means(codes, n_groups, values):
+    valid = ~np.isnan(values)
+    counts = np.bincount(codes[valid], minlength=n_groups)
+    sums = np.bincount(codes[valid], weights=values[valid], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, np.where(counts > 0, sums / counts, np.nan)
+
+
+def summarize_values(codes, n_groups, values, percentiles=summary_percentiles):
+    # Statistics of the non-missing values of every group, NaN for groups without any
+    values = np.asarray(values, dtype=np.float64)
+    counts, means = get_group_means(codes, n_groups, values)
+    # Missing values are sorted after the values of their group
+    sorted_values = values[np.lexsort((values, codes))]
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.cumsum(sizes) - sizes
+    has_values = counts > 0
+    last = starts + np.maximum(counts - 1, 0)
+    summary = {'count': counts, 'mean': means}
+    summary['min'] = np.where(has_values, sorted_values[starts], np.nan)
+    summary['max'] = np.where(has_values, sorted_values[last], np.nan)
+    # Linear interpolation between the closest ranks, as np.percentile
+    for percentile in percentiles:
+        position = np.maximum(counts - 1, 0) * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+        below = sorted_values[starts + lower]
+        above = sorted_values[starts + upper]
+        summary['p{}'.format(percentile)] = np.where(has_values, below + (above - below) * (position - lower), np.nan)
+    return summary
+
+
+def count_classes(codes, n_groups, values):
+    # Number of values of every group in each VN WQI quality class
+    classes = get_VN_WQI_class(values)
+    valid = classes >= 0
+    counts = np.bincount(codes[valid] * len(VN_WQI_class_names) + classes[valid], minlength=n_groups * len(VN_WQI_class_names))
+    return counts.reshape(n_groups, len(VN_WQI_class_names))
+
+
+def aggregate_WQI(keys, group_by, columns, percentiles=summary_percentiles):
+    # keys: DataFrame with the group_by columns, columns: dict of WQI arrays in the same row order (e.g. WQI_pred, WQI_true).
+    # One row per group, with <column>_<statistic> and <column>_class_<class> columns
+    missing_columns = [col for col in group_by if col not in keys.columns]
+    if missing_columns:
+        raise ValueError("{} cannot be grouped by, they are not in the test data!!!".format(missing_columns))
+    codes, summary = get_group_codes(keys, group_by)
+    n_groups = len(summary)
+    for name, values in columns.items():
+        for statistic, result in summarize_values(codes, n_groups, values, percentiles).items():
+            summary['{}_{}'.format(name, statistic)] = result
+        class_counts = count_classes(codes, n_groups, values)
+        for i, class_name in enumerate(VN_WQI_class_names):
+            summary['{}_class_{}'.format(name, class_name.replace(' ', '_'))] = class_counts[:, i]
+    if 'WQI_pred' in columns and 'WQI_true' in columns:
+        errors = np.asarray(columns['WQI_pred'], dtype=np.float64) - np.asarray(columns['WQI_true'], dtype=np.float64)
+        summary['WQI_error_mean'] = get_group_means(codes, n_groups, errors)[1]
+        summary['WQI_abs_error_mean'] = get_group_means(codes, n_groups, np.abs(errors))[1]
+    return summary
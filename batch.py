@@ -0,0 +1,156 @@
+# Scores many test files with a pool of worker processes, each worker loads the models once and keeps them for all its files
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import *
+from registry import ArtifactRegistry
+from table_io import file_formats, read_columns, read_table, write_table, output_extensions
+from predictor import select_columns, split_features_labels, resolve_feature_set, get_feature_columns, RunningMetrics
+
+# Registry of the worker process, created by init_worker
+worker_registry = None
+
+
+def find_files(input_path):
+    # A directory is scanned for files of a known format, anything else is used as a glob pattern
+    if os.path.isdir(input_path):
+        files = [os.path.join(input_path, name) for name in os.listdir(input_path)
+                 if os.path.splitext(name)[1].lower() in file_formats]
+    else:
+        files = [file for file in glob.glob(input_path, recursive=True) if os.path.isfile(file)]
+    return sorted(files)
+
+
+def get_batch_output_file(output_path, relative_path, model_name, feature_set, output_format='csv'):
+    # Files with the same name in different folders of a recursive glob get different results files
+    stem = os.path.splitext(relative_path)[0].replace(os.sep, '__')
+    return output_path + '/' + '{}_{}_{}_results{}'.format(stem, model_name, feature_set, output_extensions[output_format])
+
+
+def init_worker(model_path, scaler_path, model_name, preload, n_threads):
+    global worker_registry
+    # Models must not start one thread per core in every worker
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError:
+        pass
+    worker_registry = ArtifactRegistry(model_path, scaler_path)
+    if preload:
+        worker_registry.preload([model_name])
+
+
+def score_file(data_path, relative_path, model_name, output_path, output_format, fallback=False):
+    # Errors are returned with the file instead of raised, one bad file does not stop the batch
+    import pandas as pd
+    start = time.perf_counter()
+    summary = {'file': data_path, 'feature_set': None, 'rows': 0, 'output_file': None, 'error': None}
+    metrics = RunningMetrics()
+    try:
+        preprocessed_headers_list = select_columns(read_columns(data_path), verbose=False)
+        feature_set = resolve_feature_set([col for col in preprocessed_headers_list if col != 'WQI'], fallback)
+        summary['feature_set'] = feature_set
+        columns = get_feature_columns(feature_set, preprocessed_headers_list, verbose=False)
+        features, labels, _ = split_features_labels(read_table(data_path, columns=columns)[columns])
+        results = worker_registry.get_pipeline(model_name, feature_set).predict(features)
+        summary['rows'] = len(results)
+        if labels is not None:
+            metrics.update(labels, results)
+            df = pd.DataFrame({'WQI_true': labels, 'WQI_pred': results})
+        else:
+            df = pd.DataFrame({'WQI_pred': results})
+        if output_path:
+            summary['output_file'] = get_batch_output_file(output_path, relative_path, model_name, feature_set, output_format)
+            write_table(df, summary['output_file'])
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+        summary['traceback'] = traceback.format_exc()
+    summary['seconds'] = time.perf_counter() - start
+    return summary, metrics
+
+
+def get_metrics_summary(metrics):
+    if metrics.count == 0:
+        return None
+    rmse_value, mae_value, r_squared_value = metrics.compute()
+    return {'rows': metrics.count, 'RMSE': rmse_value, 'MAE': mae_value, 'R2': r_squared_value}
+
+
+def main(args):
+    files = find_files(args.input)
+    if not files:
+        raise ValueError("No test files found in {}!!!".format(args.input))
+    if args.output_path:
+        os.makedirs(args.output_path, exist_ok=True)
+    base_path = os.path.commonpath([os.path.dirname(os.path.abspath(file)) for file in files])
+    n_workers = min(args.n_workers or os.cpu_count() or 1, len(files))
+    print("Scoring {} files with {} workers".format(len(files), n_workers))
+    start = time.perf_counter()
+    file_summaries = []
+    total_metrics = RunningMetrics()
+    metrics_by_set = {}
+    # fork starts the workers without importing the modules again, the models are still loaded in each worker
+    mp_context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=mp_context, initializer=init_worker,
+                             initargs=(args.model_path, args.norm_weight_path, args.model_name, args.preload, args.n_threads)) as executor:
+        futures = {executor.submit(score_file, file, os.path.relpath(os.path.abspath(file), base_path), args.model_name,
+                                   args.output_path, args.output_format, args.fallback): file for file in files}
+        for future in as_completed(futures):
+            try:
+                summary, metrics = future.result()
+            except Exception as e:
+                # The worker process died, e.g. killed for running out of memory
+                summary, metrics = {'file': futures[future], 'feature_set': None, 'rows': 0, 'output_file': None,
+                                    'error': '{}: {}'.format(type(e).__name__, e), 'seconds': None}, RunningMetrics()
+            summary['metrics'] = get_metrics_summary(metrics)
+            total_metrics.merge(metrics)
+            if summary['feature_set'] is not None:
+                metrics_by_set.setdefault(summary['feature_set'], RunningMetrics()).merge(metrics)
+            if summary['error'] is not None:
+                print("{} failed!!! {}".format(summary['file'], summary['error']))
+            file_summaries.append(summary)
+    elapsed = time.perf_counter() - start
+    file_summaries.sort(key=lambda summary: summary['file'])
+    n_rows = sum(summary['rows'] for summary in file_summaries)
+    n_failed = sum(summary['error'] is not None for summary in file_summaries)
+    report = {
+        'model_name': args.model_name, 'workers': n_workers, 'files': len(files), 'failed': n_failed, 'rows': n_rows,
+        'seconds': elapsed, 'rows_per_s': n_rows / elapsed, 'files_per_s': len(files) / elapsed,
+        'metrics': get_metrics_summary(total_metrics),
+        'metrics_by_feature_set': {feature_set: get_metrics_summary(metrics) for feature_set, metrics in sorted(metrics_by_set.items())},
+        'file_results': file_summaries,
+    }
+    summary_file = args.summary_file or (args.output_path or '.') + '/batch_summary.json'
+    with open(summary_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Scored {} rows from {} files ({} failed) in {:.2f} s ({:.0f} rows/s)".format(
+        n_rows, len(files) - n_failed, n_failed, elapsed, report['rows_per_s']))
+    if report['metrics'] is not None:
+        print("RMSE: {:.4f}".format(report['metrics']['RMSE']))
+        print("MAE: {:.4f}".format(report['metrics']['MAE']))
+        print("R²: {:.4f}".format(report['metrics']['R2']))
+    print("Summary written to {}".format(summary_file))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help="Folder of test files or a glob pattern, e.g. 'data/**/*.csv'")
+    parser.add_argument('--model_name', type=str, default='XGB', choices=model_names)
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--output_path', type=str, default='results', required=False)
+    parser.add_argument('--output_format', type=str, default='csv', choices=sorted(output_extensions), help='Format of the results files', required=False)
+    parser.add_argument('--n_workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)', required=False)
+    parser.add_argument('--n_threads', type=int, default=1, help='Number of threads each worker may use to predict', required=False)
+    parser.add_argument('--fallback', action='store_true', help='Score files whose columns match no feature set with the richest feature set they contain')
+    parser.add_argument('--preload', action='store_true', help='Load the model for every feature set when a worker starts instead of on first use')
+    parser.add_argument('--summary_file', type=str, default=None, help='Path to the JSON summary (default: <output_path>/batch_summary.json)', required=False)
+    args = parser.parse_args()
+    main(args)
+    print("Batch prediction finished.")
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from utils import *
+from registry import artifact_exists, get_model_file, get_scaler_file, load_pickle, load_scaler_file
+from predictor import preprocess_data, split_features_labels, get_feature_sets, get_model_names
+
+
+# Ranges of the synthetic measurements, wide enough to cover every breakpoint segment of the VN WQI
+synthetic_ranges = {
+    'PO4': (0, 5), 'BOD5': (0, 60), 'DO': (0, 15), 'NO3': (0, 20), 'NO2': (0, 0.1), 'COD': (0, 200),
+    'NH4': (0, 6), 'Coliform': (0, 12000), 'pH': (5, 9.5), 'temperature': (15, 35), 'WQI': (10, 100),
+}
+
+
+def generate_station_data(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'Year': rng.integers(2010, 2025, n_rows),
+        'Period': rng.integers(1, 5, n_rows),
+        'Location': rng.choice(['S{:03d}'.format(i) for i in range(100)], n_rows),
+    })
+    for col, (low, high) in synthetic_ranges.items():
+        data[col] = rng.uniform(low, high, n_rows).astype(np.float32 if col != 'temperature' else np.float64)
+    return data
+
+
+def time_stage(func, repeats):
+    # Latencies of `repeats` runs after one warm-up run, plus the peak traced allocation of one extra run
+    func()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return np.array(latencies), peak_memory
+
+
+def summarize(stage, n_rows, latencies, peak_memory, **keys):
+    return dict(stage=stage, n_rows=n_rows, **keys,
+                repeats=len(latencies),
+                latency_s={'min': float(latencies.min()), 'mean': float(latencies.mean()),
+                           'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                           'max': float(latencies.max())},
+                rows_per_s=float(n_rows / np.median(latencies)),
+                peak_memory_bytes=int(peak_memory))
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def get_sizes(sizes):
+    return [int(float(size)) for size in sizes.split(',')]
+
+
+def run_benchmark(args, sizes, names, sets):
+    results = []
+    skipped = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in sizes:
+            data = generate_station_data(n_rows, args.seed)
+            data_file = os.path.join(tmp_dir, 'station_data_{}.csv'.format(n_rows))
+            data.to_csv(data_file, index=False)
+            print("Generated {} rows".format(n_rows))
+
+            latencies, peak_memory = time_stage(lambda: pd.read_csv(data_file), args.repeats)
+            results.append(summarize('read_csv', n_rows, latencies, peak_memory))
+            latencies, peak_memory = time_stage(lambda: VN_WQI_Calculation(data_file), args.repeats)
+            results.append(summarize('wqi_calculation', n_rows, latencies, peak_memory))
+
+            for feature_set in sets:
+                subset = data[metadata + feature_sets[feature_set] + ['WQI']]
+                latencies, peak_memory = time_stage(lambda: split_features_labels(preprocess_data(subset, verbose=False)), args.repeats)
+                results.append(summarize('load_data', n_rows, latencies, peak_memory, feature_set=feature_set))
+
+                scaler_file = get_scaler_file(args.norm_weight_path, feature_set)
+                if not artifact_exists(scaler_file):
+                    skipped.append({'feature_set': feature_set, 'reason': '{} not found'.format(scaler_file)})
+                    continue
+                scaler = load_scaler_file(scaler_file)
+                features = split_features_labels(preprocess_data(subset, verbose=False))[0]
+                latencies, peak_memory = time_stage(lambda: scaler.transform(features), args.repeats)
+                results.append(summarize('scale', n_rows, latencies, peak_memory, feature_set=feature_set))
+                scaled_features = scaler.transform(features)
+
+                for model_name in names:
+                    model_file = get_model_file(args.model_path, model_name, feature_set)
+                    if not artifact_exists(model_file):
+                        skipped.append({'feature_set': feature_set, 'model_name': model_name, 'reason': '{} not found'.format(model_file)})
+                        continue
+                    model = load_pickle(model_file)
+                    latencies, peak_memory = time_stage(lambda: model.predict(scaled_features), args.repeats)
+                    results.append(summarize('predict', n_rows, latencies, peak_memory, feature_set=feature_set, model_name=model_name))
+                print("Benchmarked {} ({} rows)".format(feature_set, n_rows))
+            os.remove(data_file)
+    return {'environment': get_environment(), 'repeats': args.repeats, 'seed': args.seed, 'results': results, 'skipped': skipped}
+
+
+def get_result_key(result):
+    return (result['stage'], result['n_rows'], result.get('feature_set'), result.get('model_name'))
+
+
+def compare_benchmarks(report, baseline):
+    # Ratio of the median latency against a previous report, > 1 means slower
+    baseline_results = {get_result_key(result): result for result in baseline['results']}
+    print("{:<16}{:>10}{:>10}{:>8}{:>12}{:>12}{:>8}".format('Stage', 'Rows', 'Set', 'Model', 'Baseline', 'Current', 'Ratio'))
+    for result in report['results']:
+        key = get_result_key(result)
+        if key not in baseline_results:
+            continue
+        old, new = baseline_results[key]['latency_s']['p50'], result['latency_s']['p50']
+        print("{:<16}{:>10}{:>10}{:>8}{:>12.5f}{:>12.5f}{:>8.2f}".format(key[0], key[1], key[2] or '-', key[3] or '-', old, new, new / old))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='1e3,1e4,1e5', help='Comma-separated numbers of synthetic rows (1e3 to 1e7)', required=False)
+    parser.add_argument('--feature_sets', type=str, default='all', help="Comma-separated feature sets or 'all'", required=False)
+    parser.add_argument('--model_names', type=str, default='all', help="Comma-separated model names or 'all'", required=False)
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs per stage', required=False)
+    parser.add_argument('--seed', type=int, default=0, required=False)
+    parser.add_argument('--output', type=str, default='results/benchmark.json', help='Path to the JSON report', required=False)
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report of a previous run to compare against', required=False)
+    args = parser.parse_args()
+    # Names and sizes are checked before any data is generated
+    try:
+        sizes = get_sizes(args.sizes)
+        names = get_model_names(args.model_names)
+        sets = get_feature_sets(args.feature_sets)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    report = run_benchmark(args, sizes, names, sets)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Benchmark report written to {}".format(args.output))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_benchmarks(report, json.load(f))
@@ -0,0 +1,167 @@
+# Packs the model and scaler weight files into one bundle file, which can be passed as --model_path and --norm_weight_path.
+# The bundle starts with a JSON index (file, kind, name, feature set, format, offset, size and sha256 of every artifact),
+# the loader memory-maps the bundle and only reads and checks the artifacts a run uses.
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from utils import feature_sets, model_names
+
+bundle_magic = b'WQIBNDL\n'
+bundle_version = 1
+# Artifacts start at multiples of this many bytes
+bundle_alignment = 64
+artifact_formats = ['pkl', 'npz']
+
+
+def get_artifact_files(model_path, scaler_path, names=model_names, sets=feature_sets):
+    # (kind, name, feature set, format, file) of the weight files found, exports older than their pickle are left out
+    artifacts = []
+    for feature_set in sets:
+        candidates = [('scaler', 'scaler_weight', scaler_path + '/scaler_weight_' + feature_set)]
+        candidates += [('model', model_name, model_path + '/' + model_name + '_' + feature_set) for model_name in names]
+        for kind, name, stem in candidates:
+            if os.path.exists(stem + '.npz') and os.path.exists(stem + '.pkl') and \
+                    os.path.getmtime(stem + '.npz') < os.path.getmtime(stem + '.pkl'):
+                print("{}.npz is older than {}.pkl!!! Leave it out.".format(stem, stem))
+                formats = ['pkl']
+            else:
+                formats = artifact_formats
+            for artifact_format in formats:
+                if os.path.exists(stem + '.' + artifact_format):
+                    artifacts.append((kind, name, feature_set, artifact_format, stem + '.' + artifact_format))
+    return artifacts
+
+
+def pack_bundle(bundle_file, artifact_files):
+    # Written to a temporary file first, so a running server never maps a partial bundle
+    index = []
+    offset = 0
+    for kind, name, feature_set, artifact_format, file_path in artifact_files:
+        with open(file_path, 'rb') as f:
+            artifact_hash = hashlib.sha256(f.read()).hexdigest()
+        size = os.path.getsize(file_path)
+        index.append({'file': os.path.basename(file_path), 'kind': kind, 'name': name, 'feature_set': feature_set,
+                      'format': artifact_format, 'offset': offset, 'size': size, 'sha256': artifact_hash})
+        offset += -(-size // bundle_alignment) * bundle_alignment
+    # Offsets are relative to the first artifact until the size of the header, which holds them, is known
+    data_offset = 0
+    while True:
+        header = {'version': bundle_version, 'artifacts': [dict(artifact, offset=artifact['offset'] + data_offset) for artifact in index]}
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_end = -(-(len(bundle_magic) + 8 + len(header_bytes)) // bundle_alignment) * bundle_alignment
+        if header_end <= data_offset:
+            break
+        data_offset = header_end
+    index = header['artifacts']
+    header_bytes += b' ' * (data_offset - len(bundle_magic) - 8 - len(header_bytes))
+    with open(bundle_file + '.tmp', 'wb') as f:
+        f.write(bundle_magic + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for artifact, (_, _, _, _, file_path) in zip(index, artifact_files):
+            f.seek(artifact['offset'])
+            with open(file_path, 'rb') as artifact_file:
+                f.write(artifact_file.read())
+        f.truncate()
+    os.replace(bundle_file + '.tmp', bundle_file)
+    return index
+
+
+class ArtifactBundle:
+    # Memory-mapped bundle, read returns the bytes of one artifact after checking its sha256
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(bundle_magic)] != bundle_magic:
+            raise ValueError("{} is not an artifact bundle!!!".format(file_path))
+        header_size = struct.unpack('<Q', self._map[len(bundle_magic):len(bundle_magic) + 8])[0]
+        header = json.loads(self._map[len(bundle_magic) + 8:len(bundle_magic) + 8 + header_size].decode('utf-8'))
+        if header['version'] != bundle_version:
+            raise ValueError("{} has bundle version {}, this version reads version {}!!!".format(file_path, header['version'], bundle_version))
+        self.artifacts = {artifact['file']: artifact for artifact in header['artifacts']}
+
+    def __contains__(self, file_name):
+        return file_name in self.artifacts
+
+    def read(self, file_name):
+        artifact = self.artifacts[file_name]
+        data = memoryview(self._map)[artifact['offset']:artifact['offset'] + artifact['size']]
+        if hashlib.sha256(data).hexdigest() != artifact['sha256']:
+            raise ValueError("{} in {} is corrupted, its sha256 does not match the index!!!".format(file_name, self.file_path))
+        return data
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def is_bundle(file_path):
+    return os.path.isfile(file_path)
+
+
+def open_bundle(file_path):
+    # Bundles stay mapped for the life of the process, a replaced bundle is mapped again
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    with _bundles_lock:
+        if key not in _bundles:
+            _bundles[key] = ArtifactBundle(file_path)
+        return _bundles[key]
+
+
+def get_bundle_member(file_path):
+    # (bundle, file name) if file_path names a file inside a bundle, e.g. deploy.wqib/XGB_full.pkl
+    bundle_file, file_name = os.path.split(file_path)
+    if bundle_file and is_bundle(bundle_file):
+        return open_bundle(bundle_file), file_name
+    return None
+
+
+def unpack_bundle(bundle_file, model_path, scaler_path):
+    bundle = ArtifactBundle(bundle_file)
+    os.makedirs(model_path, exist_ok=True)
+    os.makedirs(scaler_path, exist_ok=True)
+    for file_name, artifact in bundle.artifacts.items():
+        output_path = scaler_path if artifact['kind'] == 'scaler' else model_path
+        with open(output_path + '/' + file_name, 'wb') as f:
+            f.write(bundle.read(file_name))
+    return len(bundle.artifacts)
+
+
+def main(args, names=model_names, sets=feature_sets):
+    if args.command == 'pack':
+        index = pack_bundle(args.bundle_path, get_artifact_files(args.model_path, args.norm_weight_path, names, sets))
+        print("{} artifacts packed into {}!!!".format(len(index), args.bundle_path))
+    elif args.command == 'unpack':
+        print("{} artifacts unpacked!!!".format(unpack_bundle(args.bundle_path, args.model_path, args.norm_weight_path)))
+    else:
+        bundle = ArtifactBundle(args.bundle_path)
+        print("{:<28}{:>8}{:>12}{:>12}  {}".format('File', 'Format', 'Offset', 'Size', 'sha256'))
+        for file_name, artifact in bundle.artifacts.items():
+            if args.command == 'verify':
+                bundle.read(file_name)
+            print("{:<28}{:>8}{:>12}{:>12}  {}".format(file_name, artifact['format'], artifact['offset'], artifact['size'], artifact['sha256'][:16]))
+        if args.command == 'verify':
+            print("{} artifacts verified!!!".format(len(bundle.artifacts)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['pack', 'unpack', 'list', 'verify'])
+    parser.add_argument('--bundle_path', type=str, default='artifacts.wqib', help='Path to the bundle file', required=False)
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--model_name', type=str, default='all', help="Models to pack, a comma-separated list of {} or 'all'".format(', '.join(model_names)), required=False)
+    parser.add_argument('--feature_sets', type=str, default='all', help="Feature sets to pack, a comma-separated list or 'all'", required=False)
+    args = parser.parse_args()
+    # Imported here, registry imports this module
+    from predictor import get_feature_sets, get_model_names
+    try:
+        names = get_model_names(args.model_name)
+        sets = get_feature_sets(args.feature_sets)
+    except ValueError as e:
+        parser.error(str(e))
+    main(args, names, sets)
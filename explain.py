@@ -0,0 +1,62 @@
+# Per-feature contributions of the predictions of the tree models (tree-path attribution, as in Saabas' treeinterpreter).
+# Moving from a node to its child adds value[child] - value[node] to the feature the node splits on. Summed along the
+# path, every leaf holds a fixed contribution vector, so a batch is explained by one apply() of the trees and a sum
+# of these vectors: prediction = expected value + sum of the contributions.
+import numpy as np
+from tree_export import TreeEnsemble, export_model, get_node_depths, get_weighted_median_tree
+
+
+class TreeExplainer:
+    # Built once per (model, feature set): the contribution vector of every node and the expected value (the prediction
+    # for the cover-weighted mean of the training data) are kept with it. AdaBoost predicts the weighted median of its
+    # trees, a row is explained by the path of the tree giving that median and its expected value is the root of that tree.
+    def __init__(self, model, engine=None):
+        # The ensemble may be the one a pipeline predicts with, the engine is only used for explaining
+        self.ensemble = model if isinstance(model, TreeEnsemble) else export_model(model)
+        ensemble = self.ensemble
+        self.engine = engine
+        self.n_features = ensemble.n_features
+        self.additive = ensemble.aggregation != 'weighted_median'
+        tree_of_node = np.repeat(np.arange(ensemble.n_trees), np.diff(np.append(ensemble.roots, len(ensemble.feature))))
+        # Sums of trees are scaled by the tree weights and post_scale, the median is the value of one tree
+        scale = ensemble.tree_weights[tree_of_node] * ensemble.post_scale if self.additive else np.ones(len(tree_of_node))
+        self.node_contributions = get_node_contributions(ensemble, scale)
+        root_values = ensemble.value[ensemble.roots]
+        if self.additive:
+            self.expected_value = ensemble.post_scale * (ensemble.initial + float(np.sum(ensemble.tree_weights * root_values))) + ensemble.post_bias
+        else:
+            self.expected_value = None
+        self.root_values = root_values
+        # Rows explained at once, the leaf of every (row, tree) takes at most 16 MB
+        self.block_rows = max(1, (1 << 22) // ensemble.n_trees)
+
+    def explain(self, X, engine=None):
+        # Contributions (n_rows, n_features) and expected values (n_rows) for float32 features as the model sees them
+        leaves = self.ensemble.apply(X, engine=engine or self.engine)
+        if self.additive:
+            # Row i of the sparse matrix selects the leaves reached by row i, the product sums their vectors
+            import scipy.sparse
+            n_rows, n_trees = leaves.shape
+            paths = scipy.sparse.csr_matrix((np.ones(leaves.size), leaves.ravel(), np.arange(0, leaves.size + 1, n_trees)),
+                                            shape=(n_rows, len(self.node_contributions)))
+            return paths @ self.node_contributions, np.full(n_rows, self.expected_value)
+        trees = get_weighted_median_tree(self.ensemble.value[leaves], self.ensemble.tree_weights)
+        rows = np.arange(len(X))
+        return self.node_contributions[leaves[rows, trees]], self.root_values[trees]
+
+
+def get_node_contributions(ensemble, scale):
+    # Contribution vector of the path from the root to every node, parents come before their children
+    n_nodes = len(ensemble.feature)
+    contributions = np.zeros((n_nodes, ensemble.n_features), dtype=np.float64)
+    internal = np.flatnonzero(ensemble.feature >= 0)
+    parent = np.full(n_nodes, -1, dtype=np.int64)
+    parent[ensemble.left[internal]] = internal
+    parent[ensemble.left[internal] + 1] = internal
+    depths = get_node_depths(ensemble.left, ensemble.roots)
+    for depth in range(1, int(depths.max(initial=0)) + 1):
+        nodes = np.flatnonzero(depths == depth)
+        parents = parent[nodes]
+        contributions[nodes] = contributions[parents]
+        contributions[nodes, ensemble.feature[parents]] += scale[nodes] * (ensemble.value[nodes] - ensemble.value[parents])
+    return contributions
@@ -0,0 +1,58 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+from table_io import iter_table_chunks
+
+
+def get_file_hash(file_path, block_size=1 << 20):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_cache_files(cache_path, data_file_hash, scaler_file_hash, feature_set):
+    # The scaler is part of the key, re-fitted scaler weights must not reuse a matrix scaled with the old ones
+    prefix = cache_path + '/' + '{}_{}_{}'.format(data_file_hash, scaler_file_hash[:8], feature_set)
+    return prefix + '_features.npy', prefix + '_labels.npy'
+
+
+def write_npy(raw_file, npy_file, shape, dtype):
+    # Prepends the .npy header to raw array bytes written chunk by chunk
+    with open(npy_file + '.tmp', 'wb') as out, open(raw_file, 'rb') as raw:
+        np.lib.format.write_array_header_2_0(out, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+        shutil.copyfileobj(raw, out, 16 << 20)
+    os.replace(npy_file + '.tmp', npy_file)
+    os.remove(raw_file)
+
+
+def build_feature_cache(data_path, columns, feature_columns, scaler, features_file, labels_file, chunksize=100000):
+    # Scales the test data chunk by chunk into float32 .npy files, so the full matrix is never held in memory
+    n_rows = 0
+    with open(features_file + '.raw', 'wb') as features_raw, open(labels_file + '.raw', 'wb') as labels_raw:
+        for chunk in iter_table_chunks(data_path, chunksize, columns):
+            features = scaler.transform(chunk[feature_columns].to_numpy(dtype=np.float32))
+            features_raw.write(np.ascontiguousarray(features, dtype=np.float32).tobytes())
+            if 'WQI' in chunk.columns:
+                labels_raw.write(chunk['WQI'].to_numpy(dtype=np.float32).tobytes())
+            n_rows += len(chunk)
+    # The features file marks a complete cache, so it is moved into place last
+    if 'WQI' in columns:
+        write_npy(labels_file + '.raw', labels_file, (n_rows,), np.float32)
+    else:
+        os.remove(labels_file + '.raw')
+    write_npy(features_file + '.raw', features_file, (n_rows, len(feature_columns)), np.float32)
+
+
+def load_feature_cache(features_file, labels_file):
+    # Zero-copy views of the cached matrices
+    features = np.load(features_file, mmap_mode='r')
+    labels = np.load(labels_file, mmap_mode='r') if os.path.exists(labels_file) else None
+    return features, labels
+
+
+def iter_slices(n_rows, slice_rows):
+    for start in range(0, n_rows, slice_rows):
+        yield start, min(start + slice_rows, n_rows)
@@ -0,0 +1,193 @@
+# Re-scores cumulative archives incrementally, only rows whose values were not seen with the same model before are computed
+import argparse
+import hashlib
+import os
+import numpy as np
+from utils import *
+from registry import get_artifact_hash, get_model_file, get_scaler_file, load_pickle, load_scaler_file
+from table_io import read_columns, read_table, write_table, output_extensions
+from predictor import select_columns, resolve_feature_set
+from pipeline import FusedPipeline
+
+
+class ResultStore:
+    # Prior WQI values and predictions in a folder, one .npz per (model, feature_set, artifact version) holding the
+    # sorted row hashes and their values, so a lookup is a binary search of the rows of the run
+    def __init__(self, store_path):
+        if os.path.isfile(store_path):
+            raise ValueError("{} is a file, the result store is a folder!!!".format(store_path))
+        self.store_path = store_path
+        self._stored = {}
+
+    def get_store_file(self, model, feature_set, version):
+        return os.path.join(self.store_path, model, feature_set, version + '.npz')
+
+    def load(self, model, feature_set, version):
+        # Sorted hashes and their values, kept for the insert of the same run
+        key = (model, feature_set, version)
+        if key not in self._stored:
+            store_file = self.get_store_file(*key)
+            if os.path.exists(store_file):
+                with np.load(store_file) as npz:
+                    self._stored[key] = npz['hashes'], npz['values']
+            else:
+                self._stored[key] = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return self._stored[key]
+
+    def lookup(self, row_hashes, model, feature_set, version):
+        # Values of the stored rows and a mask of the rows found
+        stored_hashes, stored_values = self.load(model, feature_set, version)
+        values = np.full(len(row_hashes), np.nan, dtype=stored_values.dtype)
+        if len(stored_hashes) == 0:
+            return values, np.zeros(len(row_hashes), dtype=bool)
+        # Searching the hashes in sorted order reads the stored hashes sequentially, about 4 times faster
+        order = np.argsort(row_hashes)
+        positions = np.empty(len(row_hashes), dtype=np.int64)
+        positions[order] = np.searchsorted(stored_hashes, row_hashes[order])
+        positions = np.minimum(positions, len(stored_hashes) - 1)
+        found = stored_hashes[positions] == row_hashes
+        values[found] = stored_values[positions[found]]
+        return values, found
+
+    def insert(self, row_hashes, values, model, feature_set, version):
+        # row_hashes are unique and not stored yet, the merged arrays replace the file at once
+        stored_hashes, stored_values = self.load(model, feature_set, version)
+        if len(stored_hashes) == 0:
+            # Values are stored in the dtype they were computed in, e.g. float32 for XGBoost
+            stored_values = stored_values.astype(np.asarray(values).dtype)
+        order = np.argsort(row_hashes)
+        row_hashes = np.asarray(row_hashes, dtype=np.int64)[order]
+        positions = np.searchsorted(stored_hashes, row_hashes)
+        stored_hashes = np.insert(stored_hashes, positions, row_hashes)
+        stored_values = np.insert(stored_values, positions, np.asarray(values)[order])
+        self._stored[(model, feature_set, version)] = stored_hashes, stored_values
+        store_file = self.get_store_file(model, feature_set, version)
+        os.makedirs(os.path.dirname(store_file), exist_ok=True)
+        with open(store_file + '.tmp', 'wb') as f:
+            np.savez(f, hashes=stored_hashes, values=stored_values)
+        os.replace(store_file + '.tmp', store_file)
+
+    def prune(self, model, feature_set, version):
+        # Removes the values computed with other versions of the artifacts
+        key_path = os.path.dirname(self.get_store_file(model, feature_set, version))
+        if not os.path.isdir(key_path):
+            return 0
+        n_removed = 0
+        for file_name in os.listdir(key_path):
+            if file_name.endswith('.npz') and file_name != version + '.npz':
+                with np.load(os.path.join(key_path, file_name)) as npz:
+                    n_removed += len(npz['hashes'])
+                os.remove(os.path.join(key_path, file_name))
+        return n_removed
+
+    def close(self):
+        self._stored.clear()
+
+
+def hash_rows(data):
+    # 64-bit hash of the values of each row, the row position and metadata are not part of it
+    import pandas as pd
+    return pd.util.hash_pandas_object(data, index=False).to_numpy().view(np.int64)
+
+
+def get_artifact_version(model_name, feature_set, model_path, scaler_path):
+    # Content hash, re-trained models or re-fitted scalers invalidate the stored predictions
+    return get_artifact_hash(get_model_file(model_path, model_name, feature_set))[:16] + '_' + \
+        get_artifact_hash(get_scaler_file(scaler_path, feature_set))[:16]
+
+
+def get_VN_WQI_version():
+    return hashlib.blake2b(repr(VN_WQI_breakpoint_tables).encode(), digest_size=8).hexdigest()
+
+
+def compute_incremental(data, key, version, store, compute):
+    # Only distinct rows missing from the store are passed to compute, results are stored for the next run
+    model, feature_set = key
+    row_hashes = hash_rows(data)
+    values, found = store.lookup(row_hashes, model, feature_set, version)
+    missing = np.flatnonzero(~found)
+    n_computed = 0
+    if len(missing) > 0:
+        unique_hashes, first_rows, inverse = np.unique(row_hashes[missing], return_index=True, return_inverse=True)
+        computed = np.asarray(compute(data.iloc[missing[first_rows]]))
+        if not found.any():
+            values = values.astype(computed.dtype)
+        values[missing] = computed[inverse]
+        store.insert(unique_hashes, computed, model, feature_set, version)
+        n_computed = len(unique_hashes)
+    return values, n_computed
+
+
+def predict_incremental(data, model_name, feature_set, store, model_path, scaler_path):
+    version = get_artifact_version(model_name, feature_set, model_path, scaler_path)
+    artifacts = {}
+
+    def predict(rows):
+        # Artifacts are only loaded if there is something to predict
+        if not artifacts:
+            artifacts['pipeline'] = FusedPipeline(load_pickle(get_model_file(model_path, model_name, feature_set)),
+                                                  load_scaler_file(get_scaler_file(scaler_path, feature_set)))
+        return artifacts['pipeline'].predict(rows.to_numpy(dtype=np.float32))
+
+    # Rows are hashed as the float32 values the model sees, so parsing noise below float32 precision does not invalidate them
+    features = data[feature_sets[feature_set]].astype(np.float32)
+    return compute_incremental(features, (model_name, feature_set), version, store, predict), version
+
+
+def VN_WQI_incremental(data, store):
+    # The columns present are part of the key, a missing parameter changes the formula
+    columns = [col for col in VN_WQI_columns if col in data.columns]
+    key = ('VN_WQI', '+'.join(columns))
+    compute = lambda rows: np.array(calculate_VN_WQI(rows), dtype=np.float64)
+    return compute_incremental(data[columns], key, get_VN_WQI_version(), store, compute)
+
+
+def main(args):
+    import pandas as pd
+    file_columns = read_columns(args.test_data_path)
+    preprocessed_headers_list = select_columns(file_columns, verbose=False)
+    feature_headers_list = [col for col in preprocessed_headers_list if col != 'WQI']
+    columns = list(preprocessed_headers_list)
+    if args.vn_wqi:
+        columns += [col for col in VN_WQI_columns if col in file_columns and col not in columns]
+    data = read_table(args.test_data_path, columns=columns)
+    print("Data loaded!!!")
+    store = ResultStore(args.store)
+    df = pd.DataFrame()
+    if 'WQI' in data.columns:
+        df['WQI_true'] = data['WQI'].to_numpy(dtype=np.float32)
+    output_name = 'VN_WQI'
+    if args.model_name != 'none':
+        feature_set = resolve_feature_set(feature_headers_list, args.fallback)
+        (results, n_computed), version = predict_incremental(data, args.model_name, feature_set, store, args.model_path, args.norm_weight_path)
+        df['WQI_pred'] = results
+        print("Predicted {} rows, {} new or changed rows computed!!!".format(len(data), n_computed))
+        if args.prune:
+            print("{} stored predictions of older artifacts removed".format(store.prune(args.model_name, feature_set, version)))
+        output_name = '{}_{}'.format(args.model_name, feature_set)
+    if args.vn_wqi:
+        VN_WQI, n_computed = VN_WQI_incremental(data, store)
+        df['VN_WQI'] = VN_WQI
+        print("Calculated VN WQI of {} rows, {} new or changed rows computed!!!".format(len(data), n_computed))
+    store.close()
+    if args.output_path:
+        write_table(df, args.output_path + '/' + '{}_incremental_results{}'.format(output_name, output_extensions[args.output_format]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test_data_path', type=str, default='examples/test_data.csv', help='Path to the test data (.csv, .parquet or .feather/.arrow)', required=False)
+    parser.add_argument('--model_name', type=str, default='XGB', choices=model_names + ['none'], help="Model to predict with, 'none' to only calculate the VN WQI")
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--fallback', action='store_true', help='Score test data whose columns match no feature set with the richest feature set they contain')
+    parser.add_argument('--vn_wqi', action='store_true', help="Also calculate the WQI based on Vietnam's standard")
+    parser.add_argument('--store', type=str, default='cache/results', help='Folder of the stored results', required=False)
+    parser.add_argument('--prune', action='store_true', help='Remove stored predictions made with older model or scaler files')
+    parser.add_argument('--output_path', type=str, default='results', required=False)
+    parser.add_argument('--output_format', type=str, default='csv', choices=sorted(output_extensions), help='Format of the results file', required=False)
+    args = parser.parse_args()
+    if args.model_name == 'none' and not args.vn_wqi:
+        parser.error("Nothing to compute with --model_name none without --vn_wqi")
+    main(args)
+    print("Prediction finished.")
@@ -0,0 +1,195 @@
+# Scores live sensor readings one by one or in small bursts, with the models kept loaded and a rolling window per Location
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+import numpy as np
+from utils import *
+from registry import ArtifactRegistry
+from predictor import get_feature_set, get_nearest_feature_set, group_rows
+
+# Raw parameters read from a reading, in the column order of SC9 followed by the temperature
+reading_columns = SC9 + ['temperature']
+
+# Bursts smaller than this get their VN WQI record by record, the array version only pays off for more readings
+min_vectorized_readings = 8
+
+# Raised by a reading with a value that is not a number or with a temperature but no DO
+reading_errors = (ValueError, TypeError, KeyError)
+
+
+class OnlineScorer:
+    # Readings are dicts of raw parameters plus an optional Location, they are turned into NumPy columns and no DataFrame is built.
+    # A burst is predicted with one scaler and model call per feature set, single readings go through score.
+    def __init__(self, model_name='XGB', model_path='models', scaler_path='scalers', window=12, fallback=False,
+                 vn_wqi=True, registry=None, preload=True, compiled=None):
+        self.model_name = model_name
+        self.window = window
+        self.fallback = fallback
+        self.vn_wqi = vn_wqi
+        self.registry = registry or ArtifactRegistry(model_path, scaler_path, compiled=compiled)
+        if preload:
+            self.registry.preload([model_name])
+        self.windows = {}
+        self._feature_sets = {}
+        self.n_scored = 0
+
+    def get_feature_set(self, pattern):
+        # pattern is the tuple of non-missing flags of the SC9 parameters, each distinct pattern is resolved once
+        if pattern not in self._feature_sets:
+            columns = [col for col, present in zip(SC9, pattern) if present]
+            feature_set = get_feature_set(columns)
+            if feature_set is None and self.fallback:
+                feature_set = get_nearest_feature_set(frozenset(columns))
+            self._feature_sets[pattern] = feature_set
+        return self._feature_sets[pattern]
+
+    def score(self, record):
+        return self.score_many([record])[0]
+
+    def score_or_error(self, records):
+        # Same as score_many, but a burst with an invalid reading is scored again reading by reading and the invalid
+        # readings get an error instead of their output. The windows are only updated once a burst is scored.
+        try:
+            return self.score_many(records)
+        except reading_errors:
+            outputs = []
+            for record in records:
+                try:
+                    outputs.append(self.score(record))
+                except reading_errors as e:
+                    outputs.append({'error': get_reading_error(e)})
+            return outputs
+
+    def score_many(self, records):
+        n_records = len(records)
+        if n_records == 0:
+            return []
+        # A missing key and None are both NaN here, only the VN WQI tells them apart
+        columns = {col: np.array([record.get(col) for record in records], dtype=np.float64) for col in reading_columns}
+        values = np.column_stack([columns[col] for col in SC9])
+        WQI_pred = [None] * n_records
+        row_feature_sets = [None] * n_records
+        for pattern, rows in group_rows(~np.isnan(values)):
+            feature_set = self.get_feature_set(tuple(pattern.tolist()))
+            if feature_set is None:
+                continue
+            pipeline = self.registry.get_pipeline(self.model_name, feature_set)
+            features = values[np.ix_(rows, [SC9.index(col) for col in feature_sets[feature_set]])].astype(np.float32)
+            for i, result in zip(rows.tolist(), pipeline.predict(features).tolist()):
+                WQI_pred[i] = result
+                row_feature_sets[i] = feature_set
+        outputs = [{'feature_set': feature_set, 'WQI_pred': result} for feature_set, result in zip(row_feature_sets, WQI_pred)]
+        if self.vn_wqi:
+            for output, VN_WQI in zip(outputs, self.calculate_VN_WQI(records, columns)):
+                output['VN_WQI'] = None if VN_WQI is None or VN_WQI != VN_WQI else VN_WQI
+        # Windows are updated in the order of the readings
+        for record, output in zip(records, outputs):
+            if 'Location' in record:
+                output['Location'] = record['Location']
+                self._update_window(output)
+        self.n_scored += n_records
+        return outputs
+
+    def calculate_VN_WQI(self, records, columns):
+        # Parameters missing from a reading are skipped like missing columns, so readings are grouped by their keys
+        if len(records) < min_vectorized_readings:
+            return [calculate_VN_WQI_record(record) for record in records]
+        first_keys = records[0].keys()
+        if all(record.keys() == first_keys for record in records):
+            groups = [([col for col in VN_WQI_columns if col in first_keys], slice(None))]
+        else:
+            patterns = {}
+            for i, record in enumerate(records):
+                patterns.setdefault(tuple(col for col in VN_WQI_columns if col in record), []).append(i)
+            groups = [(list(pattern), np.array(rows)) for pattern, rows in patterns.items()]
+        VN_WQI = [None] * len(records)
+        for present, rows in groups:
+            group_VN_WQI = calculate_VN_WQI({col: columns[col][rows] for col in present}, verbose=False)
+            if isinstance(rows, slice):
+                return group_VN_WQI
+            for i, value in zip(rows.tolist(), group_VN_WQI):
+                VN_WQI[i] = value
+        return VN_WQI
+
+    def _update_window(self, output):
+        window = self.windows.get(output['Location'])
+        if window is None:
+            window = self.windows[output['Location']] = deque(maxlen=self.window)
+        window.append((output['WQI_pred'], output.get('VN_WQI')))
+        output['WQI_pred_rolling'] = get_mean([values[0] for values in window if values[0] is not None])
+        if self.vn_wqi:
+            output['VN_WQI_rolling'] = get_mean([values[1] for values in window if values[1] is not None])
+
+    def get_window(self, location):
+        # (WQI_pred, VN_WQI) of the last readings of a Location, oldest first
+        return list(self.windows.get(location, ()))
+
+
+def get_reading_error(error):
+    if isinstance(error, KeyError):
+        return 'Invalid reading: missing parameter {}'.format(error)
+    return 'Invalid reading: {}'.format(error)
+
+
+def get_mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def iter_bursts(fd, max_batch_size, block_size=1 << 16):
+    # Every read returns the lines already available, a burst is scored together without waiting for more
+    pending = b''
+    while True:
+        block = os.read(fd, block_size)
+        if not block:
+            break
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        lines = [line for line in lines if line.strip()]
+        for start in range(0, len(lines), max_batch_size):
+            yield lines[start:start + max_batch_size]
+    if pending.strip():
+        yield [pending]
+
+
+def main(args):
+    scorer = OnlineScorer(args.model_name, args.model_path, args.norm_weight_path, args.window, args.fallback, not args.no_vn_wqi,
+                          compiled=args.compiled_models)
+    print("Models loaded!!!", file=sys.stderr)
+    output = sys.stdout
+    start = time.perf_counter()
+    for lines in iter_bursts(sys.stdin.fileno(), args.max_batch_size):
+        # One output line per input line, invalid lines get an error in their place
+        records, errors = [], {}
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("a reading must be a JSON object")
+                if isinstance(record.get('Location'), (list, dict)):
+                    raise ValueError("Location must be a string or a number")
+                records.append(record)
+            except ValueError as e:
+                errors[i] = {'error': get_reading_error(e)}
+        results = iter(scorer.score_or_error(records))
+        output.write(''.join(json.dumps(errors[i] if i in errors else next(results)) + '\n' for i in range(len(lines))))
+        output.flush()
+    elapsed = time.perf_counter() - start
+    print("Scored {} readings in {:.2f} s ({:.0f} readings/s)".format(scorer.n_scored, elapsed, scorer.n_scored / max(elapsed, 1e-9)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='XGB', choices=model_names)
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--window', type=int, default=12, help='Number of readings per Location in the rolling window', required=False)
+    parser.add_argument('--max_batch_size', type=int, default=1024, help='Maximum number of readings predicted together', required=False)
+    parser.add_argument('--fallback', action='store_true', help='Score readings whose parameters match no feature set with the richest feature set they contain')
+    parser.add_argument('--compiled_models', type=str, nargs='?', const='numpy', default=None, choices=['numpy', 'numba'],
+                        help='Predict with the models exported by predictor.py --export_model_npz, evaluated with NumPy (default) or Numba')
+    parser.add_argument('--no_vn_wqi', action='store_true', help="Do not calculate the WQI based on Vietnam's standard")
+    args = parser.parse_args()
+    main(args)
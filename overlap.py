@@ -0,0 +1,109 @@
+# Overlaps the stages of a chunked run: chunk N+1 is read in one thread while chunk N is predicted in the calling
+# thread and chunk N-1 is written in another. The queues between the stages are bounded, a stage that runs ahead
+# blocks until the next one catches up, and each queue is first in first out, so the results keep the row order.
+import queue
+import threading
+
+# Marks the end of a queue
+_end = object()
+
+
+def put_until_stopped(items, item, stopped):
+    # Blocks while the queue is full, gives up once the other side has stopped
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class Prefetcher:
+    # Iterates over an iterable consumed by a background thread, at most max_queued items ahead of the caller.
+    # An error of the iterable is raised by the caller's next().
+    def __init__(self, iterable, max_queued=2):
+        self._items = queue.Queue(max_queued)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not put_until_stopped(self._items, (item, None), self._stopped):
+                    return
+        except BaseException as e:
+            put_until_stopped(self._items, (_end, e), self._stopped)
+            return
+        put_until_stopped(self._items, (_end, None), self._stopped)
+
+    def __iter__(self):
+        while True:
+            item, error = self._items.get()
+            if item is _end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    def close(self):
+        # Stops reading ahead, the item being read is finished first
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BackgroundWriter:
+    # Calls write(*args) in a background thread for the submitted arguments, in the order they were submitted.
+    # submit() blocks while max_queued calls are waiting. An error of write is raised by the next submit() or close().
+    def __init__(self, write, max_queued=2):
+        self.write = write
+        self._items = queue.Queue(max_queued)
+        self._stopped = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._items.get()
+            if args is _end:
+                return
+            try:
+                self.write(*args)
+            except BaseException as e:
+                self._error = e
+                self._stopped.set()
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, *args):
+        self._raise_error()
+        put_until_stopped(self._items, args, self._stopped)
+        self._raise_error()
+
+    def close(self):
+        # Waits for the submitted calls to be written
+        put_until_stopped(self._items, _end, self._stopped)
+        self._thread.join()
+        self._raise_error()
+
+    def cancel(self):
+        # Stops without waiting for the calls still queued
+        self._stopped.set()
+        while True:
+            try:
+                self._items.get_nowait()
+            except queue.Empty:
+                break
+        self._items.put(_end)
+        self._thread.join()
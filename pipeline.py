@@ -0,0 +1,157 @@
+# Scales and predicts in one pass: the affine scaling is applied in place to one block of rows at a time,
+# or folded into the thresholds of an exported tree model so the raw features are predicted directly
+import numpy as np
+from registry import NpzScaler, to_npz_scaler
+from tree_export import TreeEnsemble, get_float32_thresholds, missing_as_zero, missing_nan, missing_zero
+
+precisions = ['float32', 'float64']
+
+
+class FusedPipeline:
+    # Owns a (model, scaler) pair. The features are scaled in precision (float32 like the existing pipeline, or float64)
+    # in place in blocks of at most block_rows rows, instead of in a scaled copy of the whole matrix.
+    def __init__(self, model, scaler, precision='float32', block_rows=65536, fold=True):
+        if precision not in precisions:
+            raise ValueError("Unknown precision {}!!!".format(precision))
+        self.model = model
+        self.scaler = scaler
+        self.precision = precision
+        self.block_rows = block_rows
+        self.affine = get_affine_scaler(scaler)
+        self.folded = None
+        self._explainer = None
+        if fold and isinstance(model, TreeEnsemble) and self.affine is not None:
+            self.folded = fold_scaler(model, self.affine, precision)
+
+    def get_block(self, X, start, n_rows, columns=None):
+        # Scaled copy of n_rows rows of X from start
+        block = X[start:start + n_rows] if columns is None else X[start:start + n_rows, columns]
+        # Views of X are copied, they must not be scaled in place
+        block = block.astype(self.precision, copy=np.may_share_memory(block, X))
+        if self.affine is not None:
+            self.affine.transform(block, copy=False)
+            return block
+        return self.scaler.transform(block)
+
+    def predict(self, X, columns=None):
+        # columns (a slice or an index array) selects the features of the model from a wider X, block by block,
+        # so predicting a subset of the columns does not copy the whole matrix
+        X = np.asarray(X)
+        if self.folded is not None:
+            if columns is not None:
+                X = np.ascontiguousarray(X[:, columns], dtype=np.float32)
+            return self.folded.predict(X)
+        if len(X) == 0:
+            return self.model.predict(self.scaler.transform(X if columns is None else X[:, columns]))
+        results = None
+        for start in range(0, len(X), self.block_rows):
+            # A new block is allocated every time, CatBoost predicts a reused buffer about 50% slower
+            block = self.get_block(X, start, self.block_rows, columns)
+            block_results = self.model.predict(block)
+            if results is None:
+                results = np.empty(len(X), dtype=block_results.dtype)
+            results[start:start + len(block)] = block_results
+        return results
+
+    def get_explainer(self):
+        # Built on first use and kept with the pipeline, so pipelines cached by ArtifactRegistry keep it per (model, feature set)
+        if self._explainer is None:
+            from explain import TreeExplainer
+            self._explainer = TreeExplainer(self.folded if self.folded is not None else self.model)
+        return self._explainer
+
+    def explain(self, X, n_jobs=None, engine=None, predictions=None):
+        # Contributions of every feature (n_rows, n_features) and expected values (n_rows), blocks of rows are explained
+        # by n_jobs threads (NumPy and the Numba kernel release the GIL). Given the predictions of X, the expected values
+        # plus the contributions are checked against them
+        from concurrent.futures import ThreadPoolExecutor
+        explainer = self.get_explainer()
+        X = np.asarray(X)
+
+        def explain_block(start):
+            if self.folded is not None:
+                return explainer.explain(X[start:start + explainer.block_rows], engine)
+            return explainer.explain(self.get_block(X, start, explainer.block_rows), engine)
+
+        starts = range(0, len(X), explainer.block_rows)
+        if n_jobs == 1 or len(starts) <= 1:
+            parts = [explain_block(start) for start in starts]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                parts = list(executor.map(explain_block, starts))
+        if not parts:
+            return np.empty((0, explainer.n_features)), np.empty(0)
+        contributions = np.concatenate([part[0] for part in parts])
+        expected = np.concatenate([part[1] for part in parts])
+        if predictions is not None:
+            # Up to the float32 rounding of every tree added to the XGBoost sums
+            predictions = np.asarray(predictions, dtype=np.float64)
+            deviation = np.abs(expected + contributions.sum(axis=1) - predictions)
+            tolerance = explainer.ensemble.n_trees * np.finfo(np.float32).eps * max(1.0, float(np.abs(predictions).max(initial=0)))
+            if np.any(deviation > tolerance):
+                raise ValueError("The contributions of {} do not add up to its predictions, largest deviation {}!!!".format(
+                    type(self.model).__name__, deviation.max()))
+        return contributions, expected
+
+
+def get_affine_scaler(scaler):
+    # NpzScaler form of the scaler, None if it is not one of the affine sklearn scalers
+    if isinstance(scaler, NpzScaler):
+        return scaler
+    try:
+        return to_npz_scaler(scaler)
+    except (ValueError, KeyError, AttributeError):
+        return None
+
+
+def to_ordered(values):
+    # float32 as integers in the same order, -0.0 and 0.0 are both 0
+    bits = values.astype(np.float32).view(np.int32).astype(np.int64)
+    return np.where(bits < 0, -(bits & 0x7fffffff), bits)
+
+
+def from_ordered(ordered):
+    bits = np.where(ordered < 0, (-ordered) | 0x80000000, ordered)
+    return bits.astype(np.uint32).view(np.float32)
+
+
+def fold_scaler(ensemble, scaler, precision='float32'):
+    # Tree model on raw features equal to ensemble on scaled features, None if the scaling cannot be folded.
+    # The scaled value of x as the model sees it, f(x) = float32(transform(x)), is non-decreasing in x, so
+    # f(x) <= t exactly when x <= T, where T is the largest float32 with f(T) <= t, found by bisection.
+    internal = np.flatnonzero(ensemble.feature >= 0)
+    # LightGBM sends values scaled to about 0 to the default child, which is not a threshold on x
+    if np.any(ensemble.missing_type[internal] == missing_zero):
+        return None
+
+    def scale(values, features):
+        matrix = np.zeros((len(values), ensemble.n_features), dtype=precision)
+        matrix[np.arange(len(values)), features] = values
+        return scaler.transform(matrix, copy=False).astype(np.float32)[np.arange(len(values)), features]
+
+    grid = np.sort(np.concatenate([[-np.inf, np.inf], np.random.default_rng(0).normal(size=1024) * 10 ** np.linspace(-3, 6, 1024)]))
+    grid = grid.astype(np.float32)
+    for feature in range(ensemble.n_features):
+        scaled = scale(grid, np.full(len(grid), feature))
+        if np.any(np.isnan(scaled)) or np.any(np.diff(scaled) < 0):
+            return None
+    features = ensemble.feature[internal]
+    threshold = get_float32_thresholds(ensemble.threshold[internal], ensemble.comparison)
+    lo = np.full(len(internal), to_ordered(np.array([-np.inf]))[0])
+    hi = np.full(len(internal), to_ordered(np.array([np.inf]))[0] + 1)
+    while True:
+        active = np.flatnonzero(hi - lo > 1)
+        if len(active) == 0:
+            break
+        mid = (lo[active] + hi[active]) // 2
+        below = scale(from_ordered(mid), features[active]) <= threshold[active]
+        lo[active] = np.where(below, mid, lo[active])
+        hi[active] = np.where(below, hi[active], mid)
+    arrays = {name: getattr(ensemble, name).copy() for name in TreeEnsemble.array_names}
+    arrays['threshold'][internal] = from_ordered(lo).astype(np.float64)
+    # A NaN replaced by 0 is compared after scaling, its direction does not depend on x
+    as_zero = internal[ensemble.missing_type[internal] == missing_as_zero]
+    arrays['missing_left'][as_zero] = ~(get_float32_thresholds(ensemble.threshold[as_zero], ensemble.comparison) < 0)
+    arrays['missing_type'][as_zero] = missing_nan
+    return TreeEnsemble(arrays, ensemble.kind, 'le', ensemble.aggregation, ensemble.accumulate_dtype, ensemble.output_dtype,
+                        ensemble.initial, ensemble.post_scale, ensemble.post_bias, ensemble.n_features, ensemble.engine)
@@ -1,98 +1,685 @@
+# pandas and sklearn are imported where they are used, so that --help and small runs start fast
 import numpy as np
-import pandas as pd
-import pickle
 import argparse
 from utils import *
-from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error
+from registry import ArtifactRegistry, artifact_exists, get_artifact_hash, get_model_file, get_scaler_file, load_pickle, load_scaler_file, export_scaler_npz
+from tree_export import export_model_npz
+from pipeline import FusedPipeline, precisions
+from table_io import read_columns, read_table, iter_table_chunks, write_table, TableWriter, output_extensions
+from feature_cache import get_file_hash, get_cache_files, build_feature_cache, load_feature_cache, iter_slices
+from profiling import StageProfiler, null_profiler
+from aggregation import aggregate_WQI
+from overlap import Prefetcher, BackgroundWriter
+import functools
 import math
+import os
+import threading
 
-def load_data(data_path, scaler_path):
-    data = pd.read_csv(data_path)
-    original_headers_list = data.columns.tolist()
-    print(original_headers_list)
+def select_columns(original_headers_list, verbose=True):
+    # WQ parameter columns kept from a file header, metadata and unknown columns are dropped
+    if verbose:
+        print(original_headers_list)
+    preprocessed_headers_list = []
     for col in original_headers_list:
         if col in metadata:
-            data = data.drop([col], axis=1)
+            continue
         elif col not in wq_params:
-            data = data.drop([col], axis=1)
-            print("{} is not included in WQ parameters!!! Drop it.".format(col))
-    if 'WQI' in original_headers_list:
+            if verbose:
+                print("{} is not included in WQ parameters!!! Drop it.".format(col))
+        else:
+            preprocessed_headers_list.append(col)
+    return preprocessed_headers_list
+
+def preprocess_data(data, verbose=True):
+    return data[select_columns(data.columns.tolist(), verbose)]
+
+def split_features_labels(data):
+    if 'WQI' in data.columns:
         features = data.drop(['WQI'], axis=1)
         preprocessed_headers_list = features
-        features = np.array(features).astype(np.float32)
+        features = features.to_numpy(dtype=np.float32)
         labels = data['WQI']
-        labels = np.array(labels).astype(np.float32)
+        labels = labels.to_numpy(dtype=np.float32)
     else:
         features = data
         preprocessed_headers_list = features
-        features = np.array(features).astype(np.float32)
+        features = features.to_numpy(dtype=np.float32)
         labels = None
-    if set(preprocessed_headers_list) == set(SC9):
-        feature_set = 'full'
-    elif set(preprocessed_headers_list) == set(SC8) or set(preprocessed_headers_list) == set(RmT9):
-        feature_set = 'SC8'
-    elif set(preprocessed_headers_list) == set(SC7):
-        feature_set = 'SC7'
-    elif set(preprocessed_headers_list) == set(SC6):
-        feature_set = 'SC6'
-    elif set(preprocessed_headers_list) == set(SC5):
-        feature_set = 'SC5'
-    elif set(preprocessed_headers_list) == set(SC4):
-        feature_set = 'SC4'
-    elif set(preprocessed_headers_list) == set(SC3):
-        feature_set = 'SC3'
-    elif set(preprocessed_headers_list) == set(SC2):
-        feature_set = 'SC2'
-    elif set(preprocessed_headers_list) == set(RmT3):
-        feature_set = 'RmT3'
-    elif set(preprocessed_headers_list) == set(RmT4):
-        feature_set = 'RmT4'
-    elif set(preprocessed_headers_list) == set(RmT5):
-        feature_set = 'RmT5'
-    elif set(preprocessed_headers_list) == set(RmT6):
-        feature_set = 'RmT6'
-    elif set(preprocessed_headers_list) == set(RmT7):
-        feature_set = 'RmT7'
-    elif set(preprocessed_headers_list) == set(RmT8):
-        feature_set = 'RmT8'
-    scaler = pickle.load(open(scaler_path + '/scaler_weight_' + feature_set + '.pkl', 'rb'))
-    features = scaler.transform(features)
+    return features, labels, preprocessed_headers_list
+
+def get_feature_set(preprocessed_headers_list):
+    # Feature set with exactly these columns, None if there is none
+    return feature_set_index.get(frozenset(preprocessed_headers_list))
+
+@functools.lru_cache(maxsize=None)
+def get_nearest_feature_set(columns):
+    # Richest feature set whose columns are all in the frozenset columns, the other columns are projected away
+    candidates = [feature_set for feature_set, feature_columns in feature_sets.items() if columns.issuperset(feature_columns)]
+    return max(candidates, key=lambda feature_set: len(feature_sets[feature_set]), default=None)
+
+def resolve_feature_set(preprocessed_headers_list, fallback=False):
+    columns = frozenset(preprocessed_headers_list)
+    feature_set = feature_set_index.get(columns)
+    if feature_set is None and fallback:
+        feature_set = get_nearest_feature_set(columns)
+    return check_feature_set(feature_set, preprocessed_headers_list)
+
+def get_feature_columns(feature_set, preprocessed_headers_list, verbose=True):
+    # Columns to read for a feature set, in the order the model was trained with, followed by the labels if present
+    unused_columns = [col for col in preprocessed_headers_list if col != 'WQI' and col not in feature_sets[feature_set]]
+    if verbose and unused_columns:
+        print("{} are not used by feature set {}!!! Drop them.".format(unused_columns, feature_set))
+    return feature_sets[feature_set] + (['WQI'] if 'WQI' in preprocessed_headers_list else [])
+
+def check_feature_set(feature_set, preprocessed_headers_list):
+    if feature_set is None:
+        raise ValueError("{} does not match any feature set!!!".format(list(preprocessed_headers_list)))
+    return feature_set
+
+def load_scaler(scaler_path, feature_set):
+    scaler = load_scaler_file(get_scaler_file(scaler_path, feature_set))
+    return scaler
+
+def export_scalers(scaler_path):
+    # Writes scaler_weight_<set>.npz next to every scaler pickle, later runs scale without importing sklearn
+    n_exported = 0
+    for feature_set in feature_sets:
+        scaler_file = scaler_path + '/scaler_weight_' + feature_set + '.pkl'
+        if os.path.exists(scaler_file):
+            export_scaler_npz(load_pickle(scaler_file), scaler_file[:-len('.pkl')] + '.npz')
+            n_exported += 1
+    print("{} scalers exported to .npz!!!".format(n_exported))
+
+def export_models(model_path):
+    # Writes <name>_<set>.npz next to every model pickle, the tree arrays are checked against the model before they are saved
+    n_exported = 0
+    for feature_set in feature_sets:
+        for model_name in model_names:
+            model_file = get_model_file(model_path, model_name, feature_set)
+            if os.path.exists(model_file):
+                export_model_npz(load_pickle(model_file), model_file[:-len('.pkl')] + '.npz')
+                n_exported += 1
+    print("{} models exported to .npz!!!".format(n_exported))
+
+def get_metadata_columns(original_headers_list):
+    return [col for col in metadata if col in original_headers_list]
+
+def load_features(data_path, profiler=null_profiler, fallback=False, keep_metadata=False):
+    # The feature set is detected from the file schema, then only its columns are read.
+    # With keep_metadata the metadata columns are read too and returned as a separate DataFrame, None otherwise.
+    with profiler.stage('column_filtering'):
+        original_headers_list = read_columns(data_path)
+        preprocessed_headers_list = select_columns(original_headers_list)
+        feature_headers_list = [col for col in preprocessed_headers_list if col != 'WQI']
+        metadata_columns = get_metadata_columns(original_headers_list) if keep_metadata else []
+    with profiler.stage('feature_set_detection'):
+        feature_set = resolve_feature_set(feature_headers_list, fallback)
+        columns = get_feature_columns(feature_set, preprocessed_headers_list)
+    with profiler.stage('read') as stage:
+        data = read_table(data_path, columns=metadata_columns + columns)
+        features, labels, _ = split_features_labels(data[columns])
+        metadata_data = data[metadata_columns] if keep_metadata else None
+        stage['rows'] = len(features)
+    return features, labels, feature_set, metadata_data
+
+def load_data(data_path, scaler_path, profiler=null_profiler, fallback=False):
+    features, labels, feature_set, _ = load_features(data_path, profiler, fallback)
+    with profiler.stage('scaler_load'):
+        scaler = load_scaler(scaler_path, feature_set)
+    with profiler.stage('scaling', rows=len(features)):
+        features = scaler.transform(features)
     return features, labels, feature_set
 
+# Unpickling imports the library of the model, first imports from several threads at once can deadlock
+model_load_lock = threading.Lock()
+
 def load_model(model_path, model_name, feature_set):
-    model = pickle.load(open(model_path + '/' + model_name + '_' + feature_set + '.pkl', 'rb'))
+    with model_load_lock:
+        model = load_pickle(get_model_file(model_path, model_name, feature_set))
     return model
 
-def main(args):
-    features, labels, feature_set = load_data(args.test_data_path, args.norm_weight_path)
+def predict_data(data, model_name, registry, fallback=False):
+    # Scores an in-memory DataFrame with the (model, scaler) pair cached in the registry
+    preprocessed_headers_list = select_columns(data.columns.tolist(), verbose=False)
+    feature_set = resolve_feature_set([col for col in preprocessed_headers_list if col != 'WQI'], fallback)
+    features, labels, _ = split_features_labels(data[get_feature_columns(feature_set, preprocessed_headers_list, verbose=False)])
+    results = registry.get_pipeline(model_name, feature_set).predict(features)
+    return results, labels, feature_set
+
+def group_rows(notnull):
+    # Groups the rows of a boolean matrix by their pattern, returns (pattern, row indices) pairs
+    if notnull.all():
+        return [(notnull[0], np.arange(len(notnull)))] if len(notnull) > 0 else []
+    patterns, inverse = np.unique(notnull, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(patterns) + 1))
+    return [(pattern, order[bounds[i]:bounds[i + 1]]) for i, pattern in enumerate(patterns)]
+
+def route_rows(features, fallback=False):
+    # Groups the rows of a features DataFrame by their non-null parameters and maps each group to its feature set
+    groups = []
+    for pattern, rows in group_rows(features.notna().to_numpy()):
+        columns = features.columns[pattern].tolist()
+        feature_set = get_feature_set(columns)
+        if feature_set is None and fallback:
+            feature_set = get_nearest_feature_set(frozenset(columns))
+        groups.append((feature_set, rows))
+    return groups
+
+def predict_mixed(data, model_name, registry, fallback=False):
+    # Scores every row with the model of the feature set its non-null parameters match and scatters the results back in row order
+    data = preprocess_data(data, verbose=False)
+    labels = np.array(data['WQI']).astype(np.float32) if 'WQI' in data.columns else None
+    features = data.drop(['WQI'], axis=1) if labels is not None else data
+    values = features.to_numpy(dtype=np.float32)
+    column_index = {col: i for i, col in enumerate(features.columns)}
+    results = np.full(len(features), np.nan)
+    row_feature_sets = np.full(len(features), None, dtype=object)
+    n_skipped = 0
+    for feature_set, rows in route_rows(features, fallback):
+        if feature_set is None:
+            n_skipped += len(rows)
+            continue
+        group_features = values[np.ix_(rows, [column_index[col] for col in feature_sets[feature_set]])]
+        results[rows] = registry.get_pipeline(model_name, feature_set).predict(group_features)
+        row_feature_sets[rows] = feature_set
+    if n_skipped > 0:
+        print("{} rows do not match any feature set!!! Skip them.".format(n_skipped))
+    return results, labels, row_feature_sets
+
+def main_mixed(args):
+    import pandas as pd
+    registry = ArtifactRegistry(args.model_path, args.norm_weight_path, precision=args.precision)
+    data = read_table(args.test_data_path, columns=select_columns(read_columns(args.test_data_path)))
+    print("Data loaded!!!")
+    results, labels, row_feature_sets = predict_mixed(data, args.model_name, registry, args.fallback)
+    print("Predicted with feature sets {}!!!".format(sorted(set(row_feature_sets[row_feature_sets != None]))))
+    if args.output_path:
+        df = pd.DataFrame({'WQI_pred': results, 'feature_set': row_feature_sets})
+        if labels is not None:
+            df.insert(0, 'WQI_true', labels)
+        write_table(df, get_output_file(args.output_path, args.model_name, 'mixed', args.output_format))
+        predicted = ~np.isnan(results)
+        if labels is not None and predicted.any():
+            print("Calulating metrics...")
+            print_metrics(*calculate_metrics(labels[predicted], results[predicted]))
+
+def get_output_file(output_path, model_name, feature_set, output_format='csv'):
+    return output_path + '/' + '{}_{}_results{}'.format(model_name, feature_set, output_extensions[output_format])
+
+def print_metrics(rmse_value, mae_value, r_squared_value):
+    print("RMSE: {:.4f}".format(rmse_value))
+    print("MAE: {:.4f}".format(mae_value))
+    print("R²: {:.4f}".format(r_squared_value))
+
+class RunningMetrics:
+    # Accumulates RMSE/MAE/R² chunk by chunk without keeping labels and predictions
+    def __init__(self):
+        self.count = 0
+        self.sum_squared_error = 0.0
+        self.sum_absolute_error = 0.0
+        self.labels_mean = 0.0
+        self.labels_m2 = 0.0
+
+    def update(self, labels, results):
+        labels = np.asarray(labels, dtype=np.float64)
+        errors = labels - np.asarray(results, dtype=np.float64)
+        count = len(labels)
+        if count == 0:
+            return
+        self.sum_squared_error += float(np.sum(errors ** 2))
+        self.sum_absolute_error += float(np.sum(np.abs(errors)))
+        # Merge the mean and sum of squared deviations of the labels (Chan et al.)
+        chunk_mean = float(np.mean(labels))
+        chunk_m2 = float(np.sum((labels - chunk_mean) ** 2))
+        delta = chunk_mean - self.labels_mean
+        total = self.count + count
+        self.labels_mean += delta * count / total
+        self.labels_m2 += chunk_m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def merge(self, other):
+        # Combines the metrics accumulated on another part of the data, e.g. in another process
+        if other.count == 0:
+            return
+        delta = other.labels_mean - self.labels_mean
+        total = self.count + other.count
+        self.sum_squared_error += other.sum_squared_error
+        self.sum_absolute_error += other.sum_absolute_error
+        self.labels_mean += delta * other.count / total
+        self.labels_m2 += other.labels_m2 + delta ** 2 * self.count * other.count / total
+        self.count = total
+
+    def compute(self):
+        rmse_value = math.sqrt(self.sum_squared_error / self.count)
+        mae_value = self.sum_absolute_error / self.count
+        if self.labels_m2 == 0:
+            r_squared_value = 1.0 if self.sum_squared_error == 0 else 0.0
+        else:
+            r_squared_value = 1 - self.sum_squared_error / self.labels_m2
+        return rmse_value, mae_value, r_squared_value
+
+def iter_feature_chunks(chunks, columns, profiler=null_profiler, metadata_columns=None):
+    while True:
+        with profiler.stage('read') as stage:
+            chunk = next(chunks, None)
+            if chunk is not None:
+                features, labels, _ = split_features_labels(chunk[columns])
+                metadata_data = chunk[metadata_columns] if metadata_columns is not None else None
+                stage['rows'] = len(features)
+        if chunk is None:
+            return
+        yield features, labels, metadata_data
+
+def main_chunked(args, profiler=null_profiler):
+    import pandas as pd
+    metrics = RunningMetrics()
+    output_file = None
+    writer = None
+    n_rows = 0
+    # Metadata, labels and predictions of every chunk are kept for --aggregate, the features are not
+    aggregated = []
+    with profiler.stage('column_filtering'):
+        original_headers_list = read_columns(args.test_data_path)
+        preprocessed_headers_list = select_columns(original_headers_list)
+        metadata_columns = get_metadata_columns(original_headers_list) if args.keep_metadata or args.aggregate else None
+    with profiler.stage('feature_set_detection'):
+        feature_set = resolve_feature_set([col for col in preprocessed_headers_list if col != 'WQI'], args.fallback)
+        columns = get_feature_columns(feature_set, preprocessed_headers_list)
+    chunks = iter_table_chunks(args.test_data_path, args.chunksize, (metadata_columns or []) + columns)
+    chunks = iter_feature_chunks(chunks, columns, profiler, metadata_columns)
+    # With --pipelined the next chunks are read and the previous ones written while a chunk is predicted
+    if args.pipelined:
+        chunks = Prefetcher(chunks, args.max_queued_chunks)
+    try:
+        for i, (features, labels, metadata_data) in enumerate(chunks):
+            if i == 0:
+                with profiler.stage('scaler_load'):
+                    scaler = load_scaler(args.norm_weight_path, feature_set)
+                print("Scaler loaded!!!")
+                with profiler.stage('model_load'):
+                    pipeline = FusedPipeline(load_model(args.model_path, args.model_name, feature_set), scaler, args.precision)
+                print("Model loaded!!!")
+                if args.output_path:
+                    output_file = TableWriter(get_output_file(args.output_path, args.model_name, feature_set, args.output_format))
+                    if args.pipelined:
+                        writer = BackgroundWriter(write_results_chunk, args.max_queued_chunks)
+            # Scaling is part of the predict stage
+            with profiler.stage('predict', rows=len(features)):
+                results = pipeline.predict(features)
+            explained = explain_features(args, pipeline, features, results, profiler)
+            written_metadata = metadata_data if args.keep_metadata else None
+            if writer is not None:
+                writer.submit(output_file, labels, results, metrics, profiler, written_metadata, feature_set, explained)
+            elif output_file is not None:
+                write_results_chunk(output_file, labels, results, metrics, profiler, written_metadata, feature_set, explained)
+            if args.aggregate:
+                aggregated.append((metadata_data, labels, results))
+            n_rows += len(features)
+            print("Predicted {} rows".format(n_rows))
+        if writer is not None:
+            writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.cancel()
+        raise
+    finally:
+        if args.pipelined:
+            chunks.close()
+    if output_file is not None:
+        with profiler.stage('write'):
+            output_file.close()
+        if metrics.count > 0:
+            print("Calulating metrics...")
+            print_metrics(*metrics.compute())
+    if aggregated:
+        metadata_data = pd.concat([chunk_metadata for chunk_metadata, _, _ in aggregated], ignore_index=True)
+        labels = np.concatenate([labels for _, labels, _ in aggregated]) if aggregated[0][1] is not None else None
+        results = np.concatenate([results for _, _, results in aggregated])
+        write_summaries(args, feature_set, metadata_data, labels, results, profiler)
+
+def add_metadata_columns(df, metadata_data):
+    # Metadata columns first, the row order of both is the order of the test data
+    import pandas as pd
+    if metadata_data is None:
+        return df
+    return pd.concat([metadata_data.reset_index(drop=True), df], axis=1)
+
+def explain_features(args, pipeline, features, results, profiler=null_profiler):
+    # (contributions, expected values) of the predictions with --explain, None otherwise
+    if not args.explain:
+        return None
+    with profiler.stage('explain', rows=len(features)):
+        return pipeline.explain(features, args.n_jobs, args.explain_engine, results)
+
+def add_contribution_columns(df, feature_set, explained):
+    # WQI_expected and one contribution_<feature> column per feature after WQI_pred, WQI_expected plus the
+    # contributions of a row is its WQI_pred
+    import pandas as pd
+    if explained is None:
+        return df
+    contributions, expected = explained
+    explained_df = pd.DataFrame(contributions, columns=['contribution_' + col for col in feature_sets[feature_set]])
+    explained_df.insert(0, 'WQI_expected', expected)
+    position = df.columns.get_loc('WQI_pred') + 1
+    return pd.concat([df.iloc[:, :position], explained_df, df.iloc[:, position:]], axis=1)
+
+def write_results_chunk(output_file, labels, results, metrics, profiler=null_profiler, metadata_data=None, feature_set=None, explained=None):
+    import pandas as pd
+    if labels is not None:
+        with profiler.stage('metrics', rows=len(labels)):
+            metrics.update(labels, results)
+    with profiler.stage('write', rows=len(results)):
+        if labels is not None:
+            df = pd.DataFrame({'WQI_true': labels, 'WQI_pred': results})
+        else:
+            df = pd.DataFrame({'WQI_pred': results})
+        output_file.write(add_metadata_columns(add_contribution_columns(df, feature_set, explained), metadata_data))
+
+def get_summary_file(output_path, model_name, feature_set, group_by, summary_format='parquet'):
+    return output_path + '/' + '{}_{}_summary_by_{}{}'.format(model_name, feature_set, '_'.join(group_by), output_extensions[summary_format])
+
+def write_summaries(args, feature_set, metadata_data, labels, results, profiler=null_profiler):
+    # One table per --aggregate grouping with the statistics of the predicted and calculated (labelled) WQI of each group
+    columns = {'WQI_pred': results}
+    if labels is not None:
+        columns['WQI_true'] = labels
+    for group_by in args.aggregate:
+        group_by = group_by.split(',')
+        with profiler.stage('aggregate', rows=len(results)):
+            summary = aggregate_WQI(metadata_data, group_by, columns)
+        print("Summarized {} rows into {} groups by {}!!!".format(len(results), len(summary), ', '.join(group_by)))
+        if args.output_path:
+            with profiler.stage('write', rows=len(summary)):
+                write_table(summary, get_summary_file(args.output_path, args.model_name, feature_set, group_by, args.summary_format))
+
+def main_cached(args, profiler=null_profiler):
+    # Scaled float32 features are cached as .npy per (test data, scaler, feature set) and memory-mapped by later runs
+    with profiler.stage('column_filtering'):
+        preprocessed_headers_list = select_columns(read_columns(args.test_data_path))
+        feature_headers_list = [col for col in preprocessed_headers_list if col != 'WQI']
+    with profiler.stage('feature_set_detection'):
+        feature_set = resolve_feature_set(feature_headers_list, args.fallback)
+        columns = get_feature_columns(feature_set, preprocessed_headers_list)
+    scaler_file = get_scaler_file(args.norm_weight_path, feature_set)
+    os.makedirs(args.cache_dir, exist_ok=True)
+    with profiler.stage('cache_lookup'):
+        features_file, labels_file = get_cache_files(args.cache_dir, get_file_hash(args.test_data_path), get_artifact_hash(scaler_file), feature_set)
+    if os.path.exists(features_file):
+        print("Scaled features found in cache!!!")
+    else:
+        with profiler.stage('scaler_load'):
+            scaler = load_scaler_file(scaler_file)
+        # Reading and scaling are interleaved chunk by chunk while the cache is built
+        with profiler.stage('cache_build'):
+            build_feature_cache(args.test_data_path, columns, feature_sets[feature_set], scaler,
+                                features_file, labels_file, args.chunksize or 100000)
+        print("Scaled features cached!!!")
+    features, labels = load_feature_cache(features_file, labels_file)
+    with profiler.stage('model_load'):
+        model = load_model(args.model_path, args.model_name, feature_set)
+    print("Model loaded!!!")
+    metrics = RunningMetrics()
+    output_file = None
+    if args.output_path:
+        output_file = TableWriter(get_output_file(args.output_path, args.model_name, feature_set, args.output_format))
+    for start, end in iter_slices(len(features), args.slice_rows):
+        with profiler.stage('predict', rows=end - start):
+            results = model.predict(features[start:end])
+        if output_file is not None:
+            write_results_chunk(output_file, None if labels is None else labels[start:end], results, metrics, profiler)
+    print("Predicted {} rows".format(len(features)))
+    if output_file is not None:
+        with profiler.stage('write'):
+            output_file.close()
+        if metrics.count > 0:
+            print("Calulating metrics...")
+            print_metrics(*metrics.compute())
+
+def get_model_names(model_name):
+    # 'all', a comma-separated list or a single model name
+    names = model_names if model_name == 'all' else model_name.split(',')
+    for name in names:
+        if name not in model_names:
+            raise ValueError("Unknown model name {}!!! Choose from {} or 'all'.".format(name, model_names))
+    return names
+
+def calculate_metrics(labels, results):
+    from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error
+    rmse_value = math.sqrt(mean_squared_error(labels, results))
+    mae_value = mean_absolute_error(labels, results)
+    r_squared_value = r2_score(labels, results)
+    return rmse_value, mae_value, r_squared_value
+
+def print_metrics_table(metrics):
+    print("{:<10}{:>10}{:>10}{:>10}".format('Model', 'RMSE', 'MAE', 'R²'))
+    for name, (rmse_value, mae_value, r_squared_value) in metrics.items():
+        print("{:<10}{:>10.4f}{:>10.4f}{:>10.4f}".format(name, rmse_value, mae_value, r_squared_value))
+
+def main_ensemble(args, names):
+    import pandas as pd
+    features, labels, feature_set = load_data(args.test_data_path, args.norm_weight_path, fallback=args.fallback)
     print("Data loaded!!!")
-    model = load_model(args.model_path, args.model_name, feature_set)
+
+    # Every model reads the same scaled matrix, the boosting libraries release the GIL while predicting
+    def load_and_predict(model_name):
+        return load_model(args.model_path, model_name, feature_set).predict(features)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=args.n_jobs) as executor:
+        results = dict(zip(names, executor.map(load_and_predict, names)))
+    print("Predicted with {}!!!".format(', '.join(names)))
+
+    df = pd.DataFrame({'WQI_pred_' + name: results[name] for name in names})
+    df['WQI_pred_mean'] = df.mean(axis=1)
+    if args.ensemble_weights:
+        weights = np.array([float(weight) for weight in args.ensemble_weights.split(',')])
+        if len(weights) != len(names):
+            raise ValueError("{} ensemble weights given for {} models!!!".format(len(weights), len(names)))
+        df['WQI_pred_weighted'] = df[['WQI_pred_' + name for name in names]].to_numpy() @ (weights / weights.sum())
+    if args.output_path:
+        if labels is not None:
+            df.insert(0, 'WQI_true', labels)
+        write_table(df, get_output_file(args.output_path, args.model_name.replace(',', '-'), feature_set, args.output_format))
+    if labels is not None:
+        print("Calulating metrics...")
+        metrics = {name: calculate_metrics(labels, results[name]) for name in names}
+        metrics['mean'] = calculate_metrics(labels, df['WQI_pred_mean'])
+        if args.ensemble_weights:
+            metrics['weighted'] = calculate_metrics(labels, df['WQI_pred_weighted'])
+        print_metrics_table(metrics)
+
+def get_feature_sets(feature_set):
+    # 'all', a comma-separated list or a single feature set
+    names = list(feature_sets) if feature_set == 'all' else feature_set.split(',')
+    for name in names:
+        if name not in feature_sets:
+            raise ValueError("Unknown feature set {}!!! Choose from {} or 'all'.".format(name, list(feature_sets)))
+    return names
+
+def get_column_index(columns, subset):
+    # Positions of the subset in columns, as a slice (a view of the features) when they are contiguous
+    index = [columns.index(col) for col in subset]
+    if index == list(range(index[0], index[0] + len(index))):
+        return slice(index[0], index[0] + len(index))
+    return np.array(index)
+
+def main_sweep(args, names):
+    import pandas as pd
+    # Every feature set is scored from the columns of one labelled file, each model predicts a column view of the
+    # features, which is copied one block at a time while it is scaled
+    sweep_sets = get_feature_sets(args.feature_sets)
+    columns = [col for col in feature_sets['full'] if any(col in feature_sets[feature_set] for feature_set in sweep_sets)]
+    preprocessed_headers_list = select_columns(read_columns(args.test_data_path))
+    missing_columns = [col for col in columns + ['WQI'] if col not in preprocessed_headers_list]
+    if missing_columns:
+        raise ValueError("The sweep needs labelled test data with {}!!! {} are missing.".format(columns, missing_columns))
+    features, labels, _ = split_features_labels(read_table(args.test_data_path, columns=columns + ['WQI'])[columns + ['WQI']])
+    print("Data loaded!!!")
+    scalers = {}
+    tasks = []
+    for feature_set in sweep_sets:
+        if not artifact_exists(get_scaler_file(args.norm_weight_path, feature_set)):
+            print("No scaler for feature set {}!!! Skip it.".format(feature_set))
+            continue
+        scalers[feature_set] = load_scaler(args.norm_weight_path, feature_set)
+        for model_name in names:
+            if artifact_exists(get_model_file(args.model_path, model_name, feature_set)):
+                tasks.append((feature_set, model_name))
+            else:
+                print("No {} model for feature set {}!!! Skip it.".format(model_name, feature_set))
+    print("Scalers loaded!!!")
+
+    # One model is loaded per task and released after its prediction, the boosting libraries release the GIL
+    def load_and_evaluate(task):
+        feature_set, model_name = task
+        pipeline = FusedPipeline(load_model(args.model_path, model_name, feature_set), scalers[feature_set], args.precision)
+        results = pipeline.predict(features, get_column_index(columns, feature_sets[feature_set]))
+        return calculate_metrics(labels, results)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=args.n_jobs) as executor:
+        metrics = dict(zip(tasks, executor.map(load_and_evaluate, tasks)))
+    print("Predicted {} models on {} feature sets!!!".format(len(tasks), len(scalers)))
+
+    metric_names = ['RMSE', 'MAE', 'R²']
+    df = pd.DataFrame(index=pd.Index(list(scalers), name='feature_set'))
+    for i, metric_name in enumerate(metric_names):
+        for model_name in names:
+            df['{}_{}'.format(model_name, metric_name)] = [metrics[(feature_set, model_name)][i] if (feature_set, model_name) in metrics
+                                                           else np.nan for feature_set in scalers]
+    for metric_name in metric_names:
+        print(metric_name)
+        print(df[['{}_{}'.format(model_name, metric_name) for model_name in names]].rename(
+            columns=lambda col: col.split('_')[0]).to_string(float_format='{:.4f}'.format, na_rep='-'))
+    if args.output_path:
+        write_table(df.reset_index(), args.output_path + '/' + '{}_sweep_metrics{}'.format(
+            args.model_name.replace(',', '-'), output_extensions[args.output_format]))
+
+def main_batch(args, profiler=null_profiler):
+    import pandas as pd
+    # The features are scaled block by block while they are predicted, not in a scaled copy of the whole test data
+    features, labels, feature_set, metadata_data = load_features(args.test_data_path, profiler, args.fallback,
+                                                                 args.keep_metadata or bool(args.aggregate))
+    print("Data loaded!!!")
+    with profiler.stage('scaler_load'):
+        scaler = load_scaler(args.norm_weight_path, feature_set)
+    with profiler.stage('model_load'):
+        pipeline = FusedPipeline(load_model(args.model_path, args.model_name, feature_set), scaler, args.precision)
     print("Model loaded!!!")
-    results = model.predict(features)
+    with profiler.stage('predict', rows=len(features)):
+        results = pipeline.predict(features)
     print("Predicted!!!")
+    explained = explain_features(args, pipeline, features, results, profiler)
+    if explained is not None:
+        print("Explained!!!")
     if args.output_path:
+        with profiler.stage('write', rows=len(results)):
+            if labels is not None:
+                df = pd.DataFrame(zip(labels, results), columns=['WQI_true', 'WQI_pred'])
+            else:
+                df = pd.DataFrame(results, columns=['WQI_pred'])
+            df = add_contribution_columns(df, feature_set, explained)
+            if args.keep_metadata:
+                df = add_metadata_columns(df, metadata_data)
+            write_table(df, get_output_file(args.output_path, args.model_name, feature_set, args.output_format))
         if labels is not None:
-            df = pd.DataFrame(zip(labels, results), columns=['WQI_true', 'WQI_pred'])
-            df.to_csv(args.output_path + '/' + '{}_{}_results.csv'.format(args.model_name, feature_set), header=True, index=None)
             print("Calulating metrics...")
-            rmse_value = math.sqrt(mean_squared_error(labels, results))
-            print("RMSE: {:.4f}".format(rmse_value))
-            mae_value = mean_absolute_error(labels, results)
-            print("MAE: {:.4f}".format(mae_value))
-            r_squared_value = r2_score(labels, results)
-            print("R²: {:.4f}".format(r_squared_value))
+            with profiler.stage('metrics', rows=len(labels)):
+                metrics = calculate_metrics(labels, results)
+            print_metrics(*metrics)
+    if args.aggregate:
+        write_summaries(args, feature_set, metadata_data, labels, results, profiler)
+
+def report_profile(args, profiler):
+    if args.profile:
+        report = profiler.format_json() if args.profile == 'json' else profiler.format_text()
+        if args.profile_output:
+            with open(args.profile_output, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print(report)
+    if args.prometheus_file:
+        profiler.write_prometheus(args.prometheus_file, labels={'model': args.model_name})
+
+def main(args):
+    if args.export_scaler_npz or args.export_model_npz:
+        if args.export_scaler_npz:
+            export_scalers(args.norm_weight_path)
+        if args.export_model_npz:
+            export_models(args.model_path)
+        return
+    names = get_model_names(args.model_name)
+    if args.sweep and (args.mixed or args.chunksize or args.cache_dir):
+        raise ValueError("The sweep scores a whole test file!!!")
+    if len(names) > 1 and not args.sweep and (args.mixed or args.chunksize or args.cache_dir):
+        raise ValueError("Several models can only be compared on a whole test file!!!")
+    if args.pipelined and (not args.chunksize or args.mixed or args.cache_dir):
+        raise ValueError("--pipelined only applies to --chunksize runs!!!")
+    if (args.keep_metadata or args.aggregate) and (len(names) > 1 or args.sweep or args.mixed or args.cache_dir):
+        raise ValueError("--keep_metadata and --aggregate apply to single-model runs, with or without --chunksize!!!")
+    if args.explain and (len(names) > 1 or args.sweep or args.mixed or args.cache_dir):
+        raise ValueError("--explain applies to single-model runs, with or without --chunksize!!!")
+    if args.pipelined and args.profile_memory:
+        raise ValueError("--profile_memory cannot trace the overlapping stages of --pipelined!!!")
+    # Stages are only timed with --profile or --prometheus_file, ensemble and mixed runs report their total time
+    profiler = StageProfiler(trace_memory=args.profile_memory) if args.profile or args.prometheus_file else null_profiler
+    with profiler.stage('total'):
+        if args.sweep:
+            main_sweep(args, names)
+        elif len(names) > 1:
+            main_ensemble(args, names)
+        elif args.mixed:
+            main_mixed(args)
+        elif args.cache_dir:
+            main_cached(args, profiler)
+        elif args.chunksize:
+            main_chunked(args, profiler)
         else:
-            df = pd.DataFrame(results, columns=['WQI_pred'])
-            df.to_csv(args.output_path + '/' + '{}_{}_results.csv'.format(args.model_name, feature_set), header=True, index=None)
+            main_batch(args, profiler)
+    profiler.stop()
+    report_profile(args, profiler)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--model_name', type=str, default='XGB', choices=['AB', 'CB', 'GB', 'LGB', 'XGB'])
+    parser.add_argument('--model_name', type=str, default='XGB', help="One of {}, a comma-separated list of them or 'all'".format(', '.join(model_names)))
     parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
-    parser.add_argument('--test_data_path', type=str, default='examples/test_data.csv', help='Path to the test data', required=False)
+    parser.add_argument('--test_data_path', type=str, default='examples/test_data.csv', help='Path to the test data (.csv, .parquet or .feather/.arrow)', required=False)
     parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
     parser.add_argument('--output_path', type=str, default='results', required=False)
+    parser.add_argument('--output_format', type=str, default='csv', choices=sorted(output_extensions), help='Format of the results file', required=False)
+    parser.add_argument('--chunksize', type=int, default=None, help='Number of rows per chunk to stream the test data with bounded memory', required=False)
+    parser.add_argument('--pipelined', action='store_true', help='With --chunksize, read the next chunks and write the previous ones while a chunk is predicted')
+    parser.add_argument('--max_queued_chunks', type=int, default=2, help='Number of chunks --pipelined reads ahead of prediction and keeps waiting to be written', required=False)
+    parser.add_argument('--keep_metadata', action='store_true', help='Write the Year, Period and Location columns of the test data next to the predictions')
+    parser.add_argument('--aggregate', type=str, nargs='?', action='append', const='Location,Period', default=None,
+                        help='Summarize the predicted and calculated WQI per group of these comma-separated metadata columns (default Location,Period), can be repeated')
+    parser.add_argument('--summary_format', type=str, default='parquet', choices=sorted(output_extensions), help='Format of the --aggregate tables', required=False)
+    parser.add_argument('--explain', action='store_true', help='Write the contribution of every feature to each prediction and the expected WQI next to WQI_pred')
+    parser.add_argument('--explain_engine', type=str, default=None, choices=['numpy', 'numba'], help='Engine walking the trees for --explain (numba is faster when installed)', required=False)
+    parser.add_argument('--mixed', action='store_true', help='Score each row with the feature set matching its non-missing parameters')
+    parser.add_argument('--sweep', action='store_true', help='Score every feature set of --feature_sets with every model of --model_name from one labelled test file with all their columns')
+    parser.add_argument('--feature_sets', type=str, default='all', help="Feature sets of --sweep, a comma-separated list of {} or 'all'".format(', '.join(feature_sets)), required=False)
+    parser.add_argument('--ensemble_weights', type=str, default=None, help='Comma-separated weights of the listed models for a weighted ensemble prediction', required=False)
+    parser.add_argument('--n_jobs', type=int, default=None, help='Number of threads used to run several models or to explain blocks of rows', required=False)
+    parser.add_argument('--fallback', action='store_true', help='Score test data whose columns match no feature set with the richest feature set they contain')
+    parser.add_argument('--export_scaler_npz', action='store_true', help='Export the scaler weights to .npz files, which are then used instead of the pickles')
+    parser.add_argument('--export_model_npz', action='store_true', help='Export the tree models to .npz arrays, used by the server and online scorer with --compiled_models')
+    parser.add_argument('--precision', type=str, default='float32', choices=precisions, help='Precision of the scaled features (float32 matches the training data)', required=False)
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache the scaled features as memory-mapped .npy files in this folder and reuse them', required=False)
+    parser.add_argument('--slice_rows', type=int, default=65536, help='Number of cached rows predicted at once', required=False)
+    parser.add_argument('--profile', type=str, default=None, choices=['text', 'json'], help='Report wall time, CPU time, rows and allocated bytes of each stage', required=False)
+    parser.add_argument('--profile_memory', action='store_true', help='Also trace the bytes allocated by each stage (slower)')
+    parser.add_argument('--profile_output', type=str, default=None, help='Write the --profile report to this file instead of printing it', required=False)
+    parser.add_argument('--prometheus_file', type=str, default=None, help='Write the stage metrics in Prometheus text format to this file', required=False)
     args = parser.parse_args()
+    # Model names and feature sets are checked like argparse choices, before anything is loaded
+    try:
+        get_model_names(args.model_name)
+        get_feature_sets(args.feature_sets)
+    except ValueError as e:
+        parser.error(str(e))
     main(args)
-    print("Prediction finished.")
\ No newline at end of file
+    print("Prediction finished.")
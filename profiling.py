@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    # Wall time, CPU time, rows and allocated bytes per named stage, summed over repeated calls.
+    # Bytes are the peak of the memory traced by tracemalloc above the level at the start of the stage,
+    # tracing slows down allocation-heavy stages (CSV parsing and writing) a few times, so it is opt-in.
+    def __init__(self, enabled=True, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.stages = OrderedDict()
+        self._peaks = []
+        self._started_tracing = False
+        # Stages may run in several threads, e.g. with predictor.py --pipelined
+        self._lock = threading.Lock()
+
+    def _get_record(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rows': 0, 'bytes': 0 if self.trace_memory else None}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        # The yielded dict takes the number of rows if it is only known at the end of the stage: stage['rows'] = n
+        counts = {'rows': rows}
+        if not self.enabled:
+            yield counts
+            return
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            # The enclosing stage keeps its own peak before it is reset for this one
+            if self._peaks:
+                self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append([current, current])
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield counts
+        finally:
+            wall_s = time.perf_counter() - wall_start
+            cpu_s = time.process_time() - cpu_start
+            with self._lock:
+                record = self._get_record(name)
+                record['calls'] += 1
+                record['wall_s'] += wall_s
+                record['cpu_s'] += cpu_s
+                record['rows'] += counts['rows'] or 0
+            if self.trace_memory:
+                start, peak = self._peaks.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                record['bytes'] = max(record['bytes'], peak - start)
+                if self._peaks:
+                    self._peaks[-1][1] = max(self._peaks[-1][1], peak)
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_dict(self):
+        return {name: dict(record) for name, record in self.stages.items()}
+
+    def format_text(self):
+        lines = ["{:<20}{:>7}{:>11}{:>11}{:>12}{:>14}{:>13}".format('Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Rows', 'Rows/s', 'Bytes')]
+        for name, record in self.stages.items():
+            rows_per_s = record['rows'] / record['wall_s'] if record['rows'] and record['wall_s'] > 0 else float('nan')
+            lines.append("{:<20}{:>7}{:>11.4f}{:>11.4f}{:>12}{:>14.0f}{:>13}".format(
+                name, record['calls'], record['wall_s'], record['cpu_s'], record['rows'], rows_per_s,
+                '-' if record['bytes'] is None else record['bytes']))
+        return '\n'.join(lines)
+
+    def format_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def format_prometheus(self, prefix='wqi_predictor', labels=None):
+        # Text exposition format, e.g. for the textfile collector of the node exporter
+        metrics = [('stage_calls_total', 'calls', 'counter', 'Number of times the stage ran'),
+                   ('stage_wall_seconds_total', 'wall_s', 'counter', 'Wall time spent in the stage'),
+                   ('stage_cpu_seconds_total', 'cpu_s', 'counter', 'CPU time spent in the stage'),
+                   ('stage_rows_total', 'rows', 'counter', 'Rows processed by the stage')]
+        if self.trace_memory:
+            metrics.append(('stage_peak_bytes', 'bytes', 'gauge', 'Peak bytes allocated by the stage'))
+        extra_labels = ''.join(',{}="{}"'.format(key, value) for key, value in (labels or {}).items())
+        lines = []
+        for metric, field, metric_type, description in metrics:
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, description))
+            lines.append('# TYPE {}_{} {}'.format(prefix, metric, metric_type))
+            for name, record in self.stages.items():
+                lines.append('{}_{}{{stage="{}"{}}} {}'.format(prefix, metric, name, extra_labels, record[field]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_path, labels=None):
+        # Written to a temporary file first, so a scraper never reads a partial file
+        with open(file_path + '.tmp', 'w') as f:
+            f.write(self.format_prometheus(labels=labels))
+        os.replace(file_path + '.tmp', file_path)
+
+
+# Used when a run is not profiled
+null_profiler = StageProfiler(enabled=False)
@@ -0,0 +1,278 @@
+import hashlib
+import io
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils import feature_sets, model_names
+from tree_export import TreeEnsemble
+from bundle import get_bundle_member
+
+
+def artifact_exists(file_path):
+    # file_path is a file, or a file packed in a bundle given as the folder, e.g. deploy.wqib/XGB_full.pkl
+    member = get_bundle_member(file_path)
+    if member is not None:
+        return member[1] in member[0]
+    return os.path.exists(file_path)
+
+
+def get_artifact_stat(file_path):
+    # (mtime in ns, size in bytes), artifacts in a bundle have the mtime of the bundle
+    member = get_bundle_member(file_path)
+    if member is not None:
+        bundle, file_name = member
+        return os.stat(bundle.file_path).st_mtime_ns, bundle.artifacts[file_name]['size']
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_artifact(file_path):
+    # Bytes of a file, an artifact in a bundle is read from the memory map once its sha256 is checked
+    member = get_bundle_member(file_path)
+    if member is not None:
+        return member[0].read(member[1])
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def get_artifact_hash(file_path):
+    # Same hash as feature_cache.get_file_hash, so caches keyed by it survive packing the artifacts
+    member = get_bundle_member(file_path)
+    if member is not None:
+        return hashlib.blake2b(read_artifact(file_path), digest_size=16).hexdigest()
+    from feature_cache import get_file_hash
+    return get_file_hash(file_path)
+
+
+def is_exported(npz_file, pickle_file):
+    # An exported .npz is preferred unless the pickle was replaced after the export
+    return artifact_exists(npz_file) and (not artifact_exists(pickle_file) or get_artifact_stat(npz_file)[0] >= get_artifact_stat(pickle_file)[0])
+
+
+def get_model_file(model_path, model_name, feature_set, compiled=None):
+    # compiled selects the tree arrays exported by --export_model_npz, which are faster for small batches only
+    model_file = model_path + '/' + model_name + '_' + feature_set + '.pkl'
+    npz_file = model_path + '/' + model_name + '_' + feature_set + '.npz'
+    if compiled and is_exported(npz_file, model_file):
+        return npz_file
+    return model_file
+
+
+def get_scaler_file(scaler_path, feature_set):
+    scaler_file = scaler_path + '/scaler_weight_' + feature_set + '.pkl'
+    npz_file = scaler_path + '/scaler_weight_' + feature_set + '.npz'
+    if is_exported(npz_file, scaler_file):
+        return npz_file
+    return scaler_file
+
+
+def load_pickle(file_path):
+    if get_bundle_member(file_path) is not None:
+        return pickle.loads(read_artifact(file_path))
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+
+# Parameters of the sklearn scalers applied by NpzScaler, in the order of their transform
+scaler_parameters = {
+    'StandardScaler': ['mean_', 'scale_'],
+    'MinMaxScaler': ['scale_', 'min_'],
+    'RobustScaler': ['center_', 'scale_'],
+    'MaxAbsScaler': ['scale_'],
+}
+
+
+class NpzScaler:
+    # Fitted scaler parameters loaded from .npz, transform applies the same in-place operations as sklearn
+    def __init__(self, kind, parameters, clip=None, cast_parameters=False):
+        self.kind = kind
+        self.parameters = parameters
+        self.clip = clip
+        # Recent sklearn versions cast the parameters to the dtype of X before applying them
+        self.cast_parameters = cast_parameters
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as npz:
+            kind = str(npz['kind'])
+            parameters = {name: npz[name] for name in scaler_parameters[kind] if name in npz}
+            clip = npz['clip'] if 'clip' in npz else None
+            cast_parameters = bool(npz['cast_parameters']) if 'cast_parameters' in npz else False
+        return cls(kind, parameters, clip, cast_parameters)
+
+    def transform(self, X, copy=True):
+        # With copy=False a float32 or float64 array is scaled in place
+        X = np.array(X, copy=True) if copy else np.asarray(X)
+        if X.dtype not in (np.float32, np.float64):
+            X = X.astype(np.float64)
+        parameters = self.parameters
+        if self.cast_parameters:
+            parameters = {name: value.astype(X.dtype) for name, value in parameters.items()}
+        if self.kind in ('StandardScaler', 'RobustScaler'):
+            center = parameters.get('mean_', parameters.get('center_'))
+            if center is not None:
+                X -= center
+            if 'scale_' in parameters:
+                X /= parameters['scale_']
+        elif self.kind == 'MinMaxScaler':
+            X *= parameters['scale_']
+            X += parameters['min_']
+            if self.clip is not None:
+                np.clip(X, self.clip[0], self.clip[1], out=X)
+        elif self.kind == 'MaxAbsScaler':
+            X /= parameters['scale_']
+        return X
+
+
+def to_npz_scaler(scaler):
+    # NpzScaler applying the same operations as a fitted sklearn scaler, the arrays saved by export_scaler_npz
+    kind = type(scaler).__name__
+    if kind not in scaler_parameters:
+        raise ValueError("{} cannot be exported to .npz!!!".format(kind))
+    arrays = {name: getattr(scaler, name) for name in scaler_parameters[kind] if getattr(scaler, name, None) is not None}
+    # Centering and scaling can be fitted but switched off
+    for name, flag in [('mean_', 'with_mean'), ('center_', 'with_centering'), ('scale_', 'with_std'), ('scale_', 'with_scaling')]:
+        if not getattr(scaler, flag, True):
+            arrays.pop(name, None)
+    if kind == 'MinMaxScaler' and getattr(scaler, 'clip', False):
+        arrays['clip'] = np.array(scaler.feature_range, dtype=np.float64)
+    # Reproduce how the installed sklearn applies the parameters to float32 features. Casting the parameters
+    # only changes the last bit of some values, so the probe spans the magnitudes of the WQ parameters.
+    rng = np.random.default_rng(0)
+    n_features = len(arrays['scale_'] if 'scale_' in arrays else next(iter(arrays.values())))
+    probe = (rng.normal(size=(4096, n_features)) * 10 ** rng.uniform(-3, 5, size=(4096, n_features))).astype(np.float32)
+    expected = scaler.transform(probe)
+    cast_parameters = not np.array_equal(expected, NpzScaler(kind, arrays, arrays.get('clip')).transform(probe))
+    if cast_parameters and not np.array_equal(expected, NpzScaler(kind, arrays, arrays.get('clip'), True).transform(probe)):
+        raise ValueError("{} cannot be reproduced from .npz with the installed scikit-learn!!!".format(kind))
+    return NpzScaler(kind, arrays, arrays.get('clip'), cast_parameters)
+
+
+def export_scaler_npz(scaler, file_path):
+    npz_scaler = to_npz_scaler(scaler)
+    # The parameters include the clip range of a MinMaxScaler
+    np.savez(file_path, kind=np.array(npz_scaler.kind), cast_parameters=np.array(npz_scaler.cast_parameters), **npz_scaler.parameters)
+
+
+def open_npz(file_path):
+    if get_bundle_member(file_path) is not None:
+        return io.BytesIO(read_artifact(file_path))
+    return file_path
+
+
+def load_scaler_file(file_path):
+    if file_path.endswith('.npz'):
+        return NpzScaler.load(open_npz(file_path))
+    return load_pickle(file_path)
+
+
+def load_model_file(file_path, engine=None):
+    if file_path.endswith('.npz'):
+        return TreeEnsemble.load(open_npz(file_path), engine)
+    return load_pickle(file_path)
+
+
+class ArtifactRegistry:
+    # In-process cache of (model, scaler) pairs keyed by (model_name, feature_set, model mtime, scaler mtime).
+    # Least recently used pairs are evicted once max_entries pairs or max_bytes bytes (size of the pickles on disk) are exceeded.
+    # With compiled ('numpy' or 'numba'), models exported to .npz are loaded as TreeEnsemble evaluated with that engine.
+    # get_pipeline returns the FusedPipeline of a pair, scaling in precision.
+    # model_path and scaler_path may be a bundle packed by bundle.py instead of folders.
+    def __init__(self, model_path='models', scaler_path='scalers', max_entries=None, max_bytes=None, preload=False, compiled=None,
+                 precision='float32'):
+        self.model_path = model_path
+        self.scaler_path = scaler_path
+        self.compiled = compiled
+        self.precision = precision
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        if preload:
+            self.preload()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_key(self, model_name, feature_set):
+        model_file = get_model_file(self.model_path, model_name, feature_set, self.compiled)
+        scaler_file = get_scaler_file(self.scaler_path, feature_set)
+        model_mtime, model_size = get_artifact_stat(model_file)
+        scaler_mtime, scaler_size = get_artifact_stat(scaler_file)
+        key = (model_name, feature_set, model_mtime, scaler_mtime)
+        return key, model_file, scaler_file, model_size + scaler_size
+
+    def _get_entry(self, model_name, feature_set):
+        # [model, scaler, bytes, pipeline], the pipeline is built on first use
+        key, model_file, scaler_file, n_bytes = self._get_key(model_name, feature_set)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            # Artifacts replaced on disk leave a stale entry under their old mtime
+            for stale_key in [k for k in self._entries if k[:2] == key[:2]]:
+                self._remove(stale_key)
+            model = load_model_file(model_file, self.compiled)
+            scaler = load_scaler_file(scaler_file)
+            entry = self._entries[key] = [model, scaler, n_bytes, None]
+            self.n_bytes += n_bytes
+            self._evict()
+            return entry
+
+    def get(self, model_name, feature_set):
+        model, scaler = self._get_entry(model_name, feature_set)[:2]
+        return model, scaler
+
+    def get_pipeline(self, model_name, feature_set):
+        from pipeline import FusedPipeline
+        with self._lock:
+            entry = self._get_entry(model_name, feature_set)
+            if entry[3] is None:
+                entry[3] = FusedPipeline(entry[0], entry[1], self.precision)
+            return entry[3]
+
+    def get_model(self, model_name, feature_set):
+        return self.get(model_name, feature_set)[0]
+
+    def get_scaler(self, model_name, feature_set):
+        return self.get(model_name, feature_set)[1]
+
+    def _remove(self, key):
+        self.n_bytes -= self._entries.pop(key)[2]
+
+    def _evict(self):
+        # The most recently loaded pair is always kept, even if it exceeds the limits on its own
+        while len(self._entries) > 1 and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.n_bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def preload(self, model_names=model_names, feature_sets=feature_sets):
+        n_loaded = 0
+        for feature_set in feature_sets:
+            for model_name in model_names:
+                if not artifact_exists(get_model_file(self.model_path, model_name, feature_set, self.compiled)) or \
+                        not artifact_exists(get_scaler_file(self.scaler_path, feature_set)):
+                    continue
+                self.get(model_name, feature_set)
+                n_loaded += 1
+        return n_loaded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.n_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,217 @@
+import argparse
+import csv
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from utils import *
+from registry import ArtifactRegistry
+from predictor import resolve_feature_set
+
+
+class MicroBatcher:
+    # Coalesces concurrent requests for the same (model_name, feature_set) into one scale-and-predict call.
+    # A batch is closed once it holds max_batch_size rows or max_wait_ms after its first request arrived.
+    def __init__(self, registry, max_batch_size=256, max_wait_ms=1.0):
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.n_batches = 0
+        self.n_rows = 0
+        self._queues = {}
+        self._lock = threading.Lock()
+        # The batcher threads of all keys update the counters
+        self._stats_lock = threading.Lock()
+
+    def submit(self, model_name, feature_set, features):
+        future = Future()
+        key = (model_name, feature_set)
+        with self._lock:
+            if key not in self._queues:
+                self._queues[key] = queue.Queue()
+                threading.Thread(target=self._run, args=(key, self._queues[key]), daemon=True).start()
+        self._queues[key].put((features, future))
+        return future
+
+    def predict(self, model_name, feature_set, features):
+        return self.submit(model_name, feature_set, features).result()
+
+    def _run(self, key, requests):
+        model_name, feature_set = key
+        while True:
+            batch = [requests.get()]
+            n_rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while n_rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_rows += len(batch[-1][0])
+            try:
+                pipeline = self.registry.get_pipeline(model_name, feature_set)
+                features = np.concatenate([features for features, _ in batch]) if len(batch) > 1 else batch[0][0]
+                results = pipeline.predict(features)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.n_batches += 1
+                self.n_rows += n_rows
+            start = 0
+            for features, future in batch:
+                future.set_result(results[start:start + len(features)])
+                start += len(features)
+
+    def stats(self):
+        with self._stats_lock:
+            return {'batches': self.n_batches, 'rows': self.n_rows}
+
+
+def parse_rows(body, content_type):
+    # Returns the model name given in the body (if any) and the rows as dicts
+    if 'csv' in content_type:
+        reader = csv.DictReader(io.StringIO(body.decode('utf-8')))
+        return None, [{col: float(value) if value != '' else None for col, value in row.items() if col in wq_params} for row in reader]
+    request = json.loads(body)
+    if isinstance(request, list):
+        return None, request
+    rows = request.get('rows', [])
+    return request.get('model_name'), [rows] if isinstance(rows, dict) else rows
+
+
+def rows_to_features(rows, fallback=False):
+    # All rows of a request are scored with one feature set, so they must have the same parameters
+    headers = [col for col in rows[0] if col in wq_params and col != 'WQI']
+    header_set = set(headers)
+    for i, row in enumerate(rows):
+        row_headers = {col for col in row if col in wq_params and col != 'WQI'}
+        if row_headers != header_set:
+            raise ValueError("Row {} has the parameters {}, the first row has {}. All rows of a request must have the same parameters".format(
+                i, sorted(row_headers), sorted(header_set)))
+    feature_set = resolve_feature_set(headers, fallback)
+    columns = feature_sets[feature_set]
+    features = np.array([[row.get(col) for col in columns] for row in rows], dtype=np.float32)
+    return features, feature_set
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would delay small responses
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._send_json(200, {'registry': self.server.registry.stats(), 'batcher': self.server.batcher.stats()})
+        else:
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            model_name, rows = parse_rows(body, self.headers.get('Content-Type', ''))
+            model_name = parse_qs(url.query).get('model_name', [model_name or self.server.default_model_name])[0]
+            if model_name not in model_names:
+                raise ValueError("Unknown model name {}".format(model_name))
+            if len(rows) == 0:
+                raise ValueError("No rows to predict")
+            features, feature_set = rows_to_features(rows, self.server.fallback)
+        except Exception as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            results = self.server.batcher.predict(model_name, feature_set, features)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, {'model_name': model_name, 'feature_set': feature_set, 'WQI_pred': np.asarray(results).tolist()})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class UnixPredictionHandler(PredictionHandler):
+    # TCP_NODELAY does not apply to Unix sockets
+    disable_nagle_algorithm = False
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(args):
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, UnixPredictionHandler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    server.registry = ArtifactRegistry(args.model_path, args.norm_weight_path, max_entries=args.max_entries, compiled=args.compiled_models)
+    server.batcher = MicroBatcher(server.registry, args.max_batch_size, args.max_wait_ms)
+    server.default_model_name = args.model_name
+    server.fallback = args.fallback
+    server.verbose = args.verbose
+    return server
+
+
+def main(args):
+    server = create_server(args)
+    if args.preload:
+        print("{} models loaded!!!".format(server.registry.preload()))
+    print("Serving on {}".format(args.socket if args.socket else 'http://{}:{}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', required=False)
+    parser.add_argument('--port', type=int, default=8000, required=False)
+    parser.add_argument('--socket', type=str, default=None, help='Serve on this Unix socket instead of TCP', required=False)
+    parser.add_argument('--model_name', type=str, default='XGB', choices=model_names, help='Model used when a request does not name one')
+    parser.add_argument('--model_path', type=str, default='models', help='Path to the trained model files', required=False)
+    parser.add_argument('--norm_weight_path', type=str, default='scalers', help='Path to the scaler weight files', required=False)
+    parser.add_argument('--max_batch_size', type=int, default=256, help='Maximum number of rows predicted together', required=False)
+    parser.add_argument('--max_wait_ms', type=float, default=1.0, help='Maximum time a request waits for others to join its batch', required=False)
+    parser.add_argument('--max_entries', type=int, default=None, help='Maximum number of (model, scaler) pairs kept loaded', required=False)
+    parser.add_argument('--fallback', action='store_true', help='Score rows whose columns match no feature set with the richest feature set they contain')
+    parser.add_argument('--preload', action='store_true', help='Load every model and scaler at startup')
+    parser.add_argument('--compiled_models', type=str, nargs='?', const='numpy', default=None, choices=['numpy', 'numba'],
+                        help='Predict with the models exported by predictor.py --export_model_npz, evaluated with NumPy (default) or Numba')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,119 @@
+import os
+
+# File formats by extension, Feather v2 is the Arrow IPC file format
+file_formats = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather',
+    '.ipc': 'feather',
+}
+output_extensions = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def get_file_format(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in file_formats:
+        raise ValueError("Unknown file format {}!!! Use one of {}.".format(extension, sorted(file_formats)))
+    return file_formats[extension]
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.feather
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required to read and write Parquet/Feather files!!! Install it with `pip install pyarrow`.")
+    return pyarrow
+
+
+def read_columns(file_path):
+    # Column names from the file schema, no data is loaded
+    file_format = get_file_format(file_path)
+    if file_format == 'csv':
+        import pandas as pd
+        return pd.read_csv(file_path, nrows=0).columns.tolist()
+    pa = import_pyarrow()
+    if file_format == 'parquet':
+        return pa.parquet.read_schema(file_path).names
+    with pa.memory_map(file_path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_table(file_path, columns=None):
+    # Only the given columns are parsed (CSV) or read (Parquet/Feather)
+    import pandas as pd
+    file_format = get_file_format(file_path)
+    if file_format == 'csv':
+        return pd.read_csv(file_path, usecols=columns)
+    pa = import_pyarrow()
+    if file_format == 'parquet':
+        return pa.parquet.read_table(file_path, columns=columns).to_pandas()
+    return pa.feather.read_table(file_path, columns=columns, memory_map=True).to_pandas()
+
+
+def iter_table_chunks(file_path, chunksize, columns=None):
+    import pandas as pd
+    file_format = get_file_format(file_path)
+    if file_format == 'csv':
+        yield from pd.read_csv(file_path, chunksize=chunksize, usecols=columns)
+        return
+    pa = import_pyarrow()
+    dataset = pa.dataset.dataset(file_path, format='parquet' if file_format == 'parquet' else 'ipc')
+    for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+        if batch.num_rows > 0:
+            yield batch.to_pandas()
+
+
+def write_table(data, file_path):
+    file_format = get_file_format(file_path)
+    if file_format == 'csv':
+        data.to_csv(file_path, header=True, index=None)
+        return
+    import_pyarrow()
+    if file_format == 'parquet':
+        data.to_parquet(file_path, index=False)
+    else:
+        data.reset_index(drop=True).to_feather(file_path)
+
+
+class TableWriter:
+    # Appends DataFrame chunks to a CSV, Parquet or Feather file
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file_format = get_file_format(file_path)
+        self._file = None
+        self._writer = None
+
+    def write(self, data):
+        if self.file_format == 'csv':
+            if self._file is None:
+                self._file = open(self.file_path, 'w', newline='')
+                data.to_csv(self._file, header=True, index=None)
+            else:
+                data.to_csv(self._file, header=False, index=None)
+            return
+        pa = import_pyarrow()
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        if self._writer is None:
+            if self.file_format == 'parquet':
+                self._writer = pa.parquet.ParquetWriter(self.file_path, table.schema)
+            else:
+                self._writer = pa.ipc.new_file(self.file_path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,469 @@
+# Exports the tree-ensemble models (AB, CB, GB, LGB, XGB) to plain node arrays in .npz and predicts them with NumPy,
+# so a model loads in milliseconds and is evaluated without importing scikit-learn, XGBoost, LightGBM or CatBoost
+import functools
+import json
+import os
+import tempfile
+import numpy as np
+
+# LightGBM missing value handling of a node, the other frameworks only send NaN to the default child
+missing_as_zero = 0     # NaN is replaced by 0 before the comparison
+missing_zero = 1        # 0 and NaN go to the default child
+missing_nan = 2         # NaN goes to the default child
+
+# LightGBM treats values in [-kZeroThreshold, kZeroThreshold] as 0
+zero_threshold = np.float32(1e-35)
+
+# Trees are evaluated with 'numpy' or 'numba', Numba is faster per call but takes about a second to start
+default_engine = 'numpy'
+
+
+class TreeEnsemble:
+    # All trees are stored in flat node arrays, tree t starts at node roots[t]. An internal node sends a row to its left
+    # child if x[feature] <= threshold (comparison 'le') or x[feature] < threshold ('lt'), a leaf has feature -1.
+    # The right child always follows the left one. value holds the leaf values and, for internal nodes, the cover-weighted
+    # mean of their leaves, cover the training samples (or hessian sum) reaching each node. The prediction is
+    # post_scale * (initial + sum of tree_weights * leaf values) + post_bias accumulated tree by tree in accumulate_dtype,
+    # or the weighted median of the trees for AdaBoost.
+    array_names = ['feature', 'threshold', 'left', 'right', 'missing_left', 'missing_type', 'value', 'cover', 'roots', 'tree_weights']
+    scalar_names = ['kind', 'comparison', 'aggregation', 'accumulate_dtype', 'output_dtype', 'initial', 'post_scale', 'post_bias',
+                    'n_features']
+
+    def __init__(self, arrays, kind, comparison, aggregation='sum', accumulate_dtype='float64', output_dtype='float64',
+                 initial=0.0, post_scale=1.0, post_bias=0.0, n_features=None, engine=None):
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+        self.kind = kind
+        self.comparison = comparison
+        self.aggregation = aggregation
+        self.accumulate_dtype = accumulate_dtype
+        self.output_dtype = output_dtype
+        self.initial = float(initial)
+        self.post_scale = float(post_scale)
+        self.post_bias = float(post_bias)
+        self.n_features = int(n_features) if n_features is not None else int(self.feature.max()) + 1
+        self.engine = engine or default_engine
+        self._prepare()
+
+    def _prepare(self):
+        is_leaf = self.feature < 0
+        if np.any(self.right[~is_leaf] != self.left[~is_leaf] + 1):
+            raise ValueError("The right child of every node must follow its left child!!!")
+        # Leaves point to themselves, so every row can take max_depth steps without checking for leaves
+        self._left = np.where(is_leaf, np.arange(len(self.feature)), self.left).astype(np.int32)
+        self._feature = np.maximum(self.feature, 0).astype(np.int32)
+        self._threshold = get_float32_thresholds(self.threshold, self.comparison)
+        self._threshold[is_leaf] = np.inf
+        self._leaf_value = self.value.astype(self.accumulate_dtype)
+        self._has_zero_missing = bool(np.any(self.missing_type[~is_leaf] == missing_zero))
+        # Missing values only move rows at internal nodes, leaves read feature 0 and must keep their rows
+        self._is_internal = ~is_leaf
+        self.max_depth = int(get_node_depths(self.left, self.roots).max(initial=0))
+        self._unit_weights = bool(np.all(self.tree_weights == 1.0))
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @classmethod
+    def load(cls, file_path, engine=None):
+        with np.load(file_path) as npz:
+            arrays = {name: npz[name] for name in cls.array_names}
+            scalars = {name: npz[name].item() for name in cls.scalar_names}
+        return cls(arrays, engine=engine, **scalars)
+
+    def save(self, file_path):
+        np.savez(file_path, **{name: getattr(self, name) for name in self.array_names},
+                 **{name: np.array(getattr(self, name)) for name in self.scalar_names})
+
+    def apply(self, X, block_rows=None, engine=None):
+        # Leaf node of every (row, tree), engine overrides the engine of the ensemble for this call
+        X = self._check_input(X)
+        leaves = np.empty((len(X), self.n_trees), dtype=np.int32)
+        if (engine or self.engine) == 'numba':
+            kernel = get_numba_kernel()
+            if kernel is None:
+                raise ValueError("Numba is not installed!!!")
+            kernel(X, self._feature, self._threshold, self._left, self.missing_left, self.missing_type, self.roots, leaves)
+            return leaves
+        # All trees of a block of rows descend one level per step
+        block_rows = block_rows or max(1, (1 << 16) // self.n_trees)
+        for start in range(0, len(X), block_rows):
+            leaves[start:start + block_rows] = self._apply_block(X[start:start + block_rows])
+        return leaves
+
+    def _apply_block(self, X):
+        n_rows = len(X)
+        node = np.repeat(self.roots[np.newaxis, :], n_rows, axis=0)
+        X_flat = X.ravel()
+        row_offsets = (np.arange(n_rows, dtype=np.int32) * self.n_features)[:, np.newaxis]
+        has_missing = self._has_zero_missing or bool(np.isnan(X_flat).any())
+        for _ in range(self.max_depth):
+            x = X_flat[row_offsets + self._feature[node]]
+            threshold = self._threshold[node]
+            go_right = x > threshold
+            if has_missing:
+                missing_type = self.missing_type[node]
+                internal = self._is_internal[node]
+                is_nan = np.isnan(x) & internal
+                to_zero = is_nan & (missing_type != missing_nan)
+                if to_zero.any():
+                    x = np.where(to_zero, np.float32(0.0), x)
+                    go_right = np.where(to_zero, threshold < 0, go_right)
+                default = (is_nan & (missing_type == missing_nan)) | \
+                          (internal & (missing_type == missing_zero) & (np.abs(x) <= zero_threshold))
+                go_right = np.where(default, ~self.missing_left[node], go_right)
+            node = self._left[node] + go_right
+        return node
+
+    def predict_trees(self, X):
+        # Value of every tree for every row, shape (n_rows, n_trees)
+        return self._leaf_value[self.apply(X)]
+
+    def predict(self, X):
+        tree_values = self.predict_trees(X)
+        if self.aggregation == 'weighted_median':
+            results = get_weighted_median(tree_values, self.tree_weights)
+        else:
+            # Trees are added one by one like in the frameworks (cumsum is sequential), so the rounding matches theirs
+            dtype = np.dtype(self.accumulate_dtype)
+            terms = np.empty((len(tree_values), self.n_trees + 1), dtype=dtype)
+            terms[:, 0] = self.initial
+            if self._unit_weights:
+                terms[:, 1:] = tree_values
+            else:
+                np.multiply(tree_values, self.tree_weights.astype(dtype), out=terms[:, 1:])
+            results = np.cumsum(terms, axis=1, dtype=dtype)[:, -1]
+            if self.post_scale != 1.0 or self.post_bias != 0.0:
+                results = self.post_scale * results + self.post_bias
+        return results.astype(self.output_dtype, copy=False)
+
+    def _check_input(self, X):
+        # The frameworks see float32 features
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("Expected {} features, got an array of shape {}!!!".format(self.n_features, X.shape))
+        return X
+
+
+def get_float32_thresholds(threshold, comparison):
+    # Largest float32 t32 such that x <= threshold (or x < threshold) is x <= t32 for every float32 x,
+    # so the features are compared without converting them to float64
+    threshold32 = threshold.astype(np.float32)
+    too_large = threshold32.astype(np.float64) > threshold if comparison == 'le' else threshold32.astype(np.float64) >= threshold
+    threshold32[too_large] = np.nextafter(threshold32[too_large], np.float32(-np.inf))
+    return threshold32
+
+
+@functools.lru_cache(maxsize=None)
+def get_numba_kernel():
+    # Compiled on first use and cached on disk, None if Numba is not installed
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    # Each row walks a tree down to its leaf, then the next tree is walked for all rows
+    @numba.njit(cache=True, nogil=True)
+    def apply_rows(X, feature, threshold, left, missing_left, missing_type, roots, leaves):
+        for t in range(roots.shape[0]):
+            for i in range(X.shape[0]):
+                node = roots[t]
+                while left[node] != node:
+                    x = X[i, feature[node]]
+                    node_missing_type = missing_type[node]
+                    if x != x and node_missing_type != missing_nan:
+                        x = np.float32(0.0)
+                    if (x != x and node_missing_type == missing_nan) or \
+                            (node_missing_type == missing_zero and abs(x) <= zero_threshold):
+                        node = left[node] + (0 if missing_left[node] else 1)
+                    else:
+                        node = left[node] + (x > threshold[node])
+                leaves[i, t] = node
+
+    return apply_rows
+
+
+def get_node_depths(left, roots):
+    # Level by level from the roots, the right child follows the left one
+    depths = np.zeros(len(left), dtype=np.int32)
+    level, depth = roots, 0
+    while len(level) > 0:
+        depths[level] = depth
+        children = left[level]
+        children = children[children >= 0]
+        level = np.concatenate([children, children + 1])
+        depth += 1
+    return depths
+
+
+def get_weighted_median_tree(tree_values, tree_weights):
+    # Tree giving the weighted median of every row, same as AdaBoostRegressor._get_median_predict
+    sorted_idx = np.argsort(tree_values, axis=1)
+    weight_cdf = np.cumsum(tree_weights[sorted_idx], axis=1, dtype=np.float64)
+    median_or_above = weight_cdf >= 0.5 * weight_cdf[:, -1][:, np.newaxis]
+    median_idx = median_or_above.argmax(axis=1)
+    return sorted_idx[np.arange(len(tree_values)), median_idx]
+
+
+def get_weighted_median(tree_values, tree_weights):
+    return tree_values[np.arange(len(tree_values)), get_weighted_median_tree(tree_values, tree_weights)]
+
+
+class TreeBuilder:
+    # Collects the nodes of the trees of a model in the flat arrays of TreeEnsemble
+    def __init__(self):
+        self.columns = {name: [] for name in ['feature', 'threshold', 'left', 'right', 'missing_left', 'missing_type', 'value', 'cover']}
+        self.roots = []
+
+    def add_node(self, feature=-1, threshold=0.0, missing_left=True, missing_type=missing_nan, value=0.0, cover=0.0):
+        node = len(self.columns['feature'])
+        for name, item in [('feature', feature), ('threshold', threshold), ('left', -1), ('right', -1), ('missing_left', missing_left),
+                           ('missing_type', missing_type), ('value', value), ('cover', cover)]:
+            self.columns[name].append(item)
+        return node
+
+    def set_children(self, node, left, right):
+        self.columns['left'][node] = left
+        self.columns['right'][node] = right
+
+    def get_arrays(self, tree_weights=None):
+        arrays = {
+            'feature': np.array(self.columns['feature'], dtype=np.int32),
+            'threshold': np.array(self.columns['threshold'], dtype=np.float64),
+            'left': np.array(self.columns['left'], dtype=np.int32),
+            'right': np.array(self.columns['right'], dtype=np.int32),
+            'missing_left': np.array(self.columns['missing_left'], dtype=bool),
+            'missing_type': np.array(self.columns['missing_type'], dtype=np.int8),
+            'value': np.array(self.columns['value'], dtype=np.float64),
+            'cover': np.array(self.columns['cover'], dtype=np.float64),
+            'roots': np.array(self.roots, dtype=np.int32),
+        }
+        renumber_nodes(arrays)
+        arrays['tree_weights'] = np.ones(len(self.roots)) if tree_weights is None else np.asarray(tree_weights, dtype=np.float64)
+        fill_internal_values(arrays)
+        return arrays
+
+
+def renumber_nodes(arrays):
+    # Breadth first order within each tree, the two children of a node are stored next to each other
+    # and after their parent. Nodes no tree reaches (deleted by XGBoost pruning) are dropped.
+    left, right = arrays['left'].tolist(), arrays['right'].tolist()
+    order = []
+    for root in arrays['roots'].tolist():
+        position = len(order)
+        order.append(root)
+        while position < len(order):
+            node = order[position]
+            if left[node] >= 0:
+                order += [left[node], right[node]]
+            position += 1
+    order = np.array(order, dtype=np.int64)
+    new_index = np.full(len(left), -1, dtype=np.int32)
+    new_index[order] = np.arange(len(order), dtype=np.int32)
+    for name in ['feature', 'threshold', 'missing_left', 'missing_type', 'value', 'cover']:
+        arrays[name] = arrays[name][order]
+    for name in ['left', 'right']:
+        children = arrays[name][order]
+        arrays[name] = np.where(children >= 0, new_index[children], -1).astype(np.int32)
+    arrays['roots'] = new_index[arrays['roots']]
+
+
+def fill_internal_values(arrays):
+    # Internal nodes get the cover-weighted mean of their children, children come after their parent
+    feature, left, right, value, cover = arrays['feature'], arrays['left'], arrays['right'], arrays['value'], arrays['cover']
+    for node in np.flatnonzero(feature >= 0)[::-1].tolist():
+        total = cover[left[node]] + cover[right[node]]
+        if total > 0:
+            value[node] = (cover[left[node]] * value[left[node]] + cover[right[node]] * value[right[node]]) / total
+        else:
+            value[node] = 0.5 * (value[left[node]] + value[right[node]])
+        if cover[node] == 0:
+            cover[node] = total
+
+
+def add_sklearn_tree(builder, tree):
+    missing_go_to_left = getattr(tree, 'missing_go_to_left', None)
+    offset = len(builder.columns['feature'])
+    builder.roots.append(offset)
+    for node in range(tree.node_count):
+        is_leaf = tree.children_left[node] < 0
+        builder.add_node(feature=-1 if is_leaf else int(tree.feature[node]), threshold=0.0 if is_leaf else float(tree.threshold[node]),
+                         missing_left=True if missing_go_to_left is None else bool(missing_go_to_left[node]),
+                         value=float(tree.value[node].ravel()[0]), cover=float(tree.weighted_n_node_samples[node]))
+        if not is_leaf:
+            builder.set_children(offset + node, offset + int(tree.children_left[node]), offset + int(tree.children_right[node]))
+
+
+def export_gradient_boosting(model):
+    init = model.init_
+    if init == 'zero':
+        initial = 0.0
+    elif type(init).__name__ == 'DummyRegressor':
+        initial = float(np.ravel(init.constant_)[0])
+    else:
+        raise ValueError("GradientBoostingRegressor with a {} init cannot be exported!!!".format(type(init).__name__))
+    builder = TreeBuilder()
+    for estimator in model.estimators_[:, 0]:
+        add_sklearn_tree(builder, estimator.tree_)
+    return TreeEnsemble(builder.get_arrays(np.full(len(builder.roots), model.learning_rate)), 'GB', 'le',
+                        initial=initial, n_features=model.n_features_in_)
+
+
+def export_adaboost(model):
+    builder = TreeBuilder()
+    for estimator in model.estimators_:
+        if type(estimator).__name__ != 'DecisionTreeRegressor':
+            raise ValueError("AdaBoostRegressor of {} cannot be exported!!!".format(type(estimator).__name__))
+        add_sklearn_tree(builder, estimator.tree_)
+    tree_weights = model.estimator_weights_[:len(model.estimators_)]
+    return TreeEnsemble(builder.get_arrays(tree_weights), 'AB', 'le', aggregation='weighted_median', n_features=model.n_features_in_)
+
+
+def export_xgboost(model):
+    booster = model.get_booster()
+    config = json.loads(booster.save_raw('json'))['learner']
+    objective = config['objective']['name']
+    if objective not in ('reg:squarederror', 'reg:squaredlogerror', 'reg:pseudohubererror', 'reg:absoluteerror', 'reg:quantileerror'):
+        raise ValueError("XGBoost objective {} cannot be exported!!!".format(objective))
+    gradient_booster = config['gradient_booster']
+    if gradient_booster['name'] != 'gbtree':
+        raise ValueError("XGBoost booster {} cannot be exported!!!".format(gradient_booster['name']))
+    trees = gradient_booster['model']['trees']
+    # predict uses the trees up to the best iteration after early stopping
+    best_iteration = booster.attributes().get('best_iteration')
+    if best_iteration is not None:
+        iteration_indptr = gradient_booster['model'].get('iteration_indptr')
+        n_parallel = int(gradient_booster['model']['gbtree_model_param']['num_parallel_tree'])
+        n_trees = iteration_indptr[int(best_iteration) + 1] if iteration_indptr else (int(best_iteration) + 1) * n_parallel
+        trees = trees[:n_trees]
+    builder = TreeBuilder()
+    for tree in trees:
+        if any(split_type != 0 for split_type in tree['split_type']):
+            raise ValueError("XGBoost models with categorical splits cannot be exported!!!")
+        offset = len(builder.columns['feature'])
+        builder.roots.append(offset)
+        for node, (left, right) in enumerate(zip(tree['left_children'], tree['right_children'])):
+            is_leaf = left < 0
+            # split_conditions holds the threshold of an internal node and the value of a leaf, both float32 printed in
+            # shortest form, so they are rounded back to float32 before the comparison with float32 features
+            condition = float(np.float32(tree['split_conditions'][node]))
+            builder.add_node(feature=-1 if is_leaf else tree['split_indices'][node], threshold=0.0 if is_leaf else condition,
+                             missing_left=bool(tree['default_left'][node]), value=condition if is_leaf else 0.0,
+                             cover=tree['sum_hessian'][node])
+            if not is_leaf:
+                builder.set_children(offset + node, offset + left, offset + right)
+    base_score = float(config['learner_model_param']['base_score'].strip('[]'))
+    return TreeEnsemble(builder.get_arrays(), 'XGB', 'lt', accumulate_dtype='float32', output_dtype='float32',
+                        initial=np.float32(base_score), n_features=int(config['learner_model_param']['num_feature']))
+
+
+def export_lightgbm(model):
+    booster = model.booster_
+    dump = booster.dump_model()
+    objective = dump['objective'].split()[0]
+    if objective not in ('regression', 'regression_l1', 'huber', 'fair', 'quantile', 'mape'):
+        raise ValueError("LightGBM objective {} cannot be exported!!!".format(objective))
+    tree_info = dump['tree_info']
+    if booster.best_iteration > 0:
+        tree_info = tree_info[:booster.best_iteration * dump['num_tree_per_iteration']]
+    missing_types = {'None': missing_as_zero, 'Zero': missing_zero, 'NaN': missing_nan}
+    builder = TreeBuilder()
+
+    def add_node(structure):
+        if 'leaf_value' in structure:
+            return builder.add_node(value=structure['leaf_value'], cover=structure.get('leaf_count', 0))
+        if structure['decision_type'] != '<=':
+            raise ValueError("LightGBM models with categorical splits cannot be exported!!!")
+        node = builder.add_node(feature=structure['split_feature'], threshold=structure['threshold'],
+                                missing_left=structure['default_left'], missing_type=missing_types[structure['missing_type']],
+                                cover=structure['internal_count'])
+        left = add_node(structure['left_child'])
+        builder.set_children(node, left, add_node(structure['right_child']))
+        return node
+
+    for tree in tree_info:
+        builder.roots.append(add_node(tree['tree_structure']))
+    # Random forests average their trees
+    post_scale = 1.0 / len(tree_info) if dump.get('average_output') else 1.0
+    return TreeEnsemble(builder.get_arrays(), 'LGB', 'le', post_scale=post_scale, n_features=dump['max_feature_idx'] + 1)
+
+
+def export_catboost(model):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model.save_model(os.path.join(tmp_dir, 'model.json'), format='json')
+        with open(os.path.join(tmp_dir, 'model.json')) as f:
+            dump = json.load(f)
+    float_features = {feature['feature_index']: feature for feature in dump['features_info'].get('float_features', [])}
+    if dump['features_info'].get('categorical_features'):
+        raise ValueError("CatBoost models with categorical features cannot be exported!!!")
+    builder = TreeBuilder()
+    for tree in dump['oblivious_trees']:
+        # Split j of an oblivious tree sets bit j of the leaf index if x > border, the tree is unrolled level by level
+        splits = tree['splits']
+        depth = len(splits)
+        leaf_weights = tree.get('leaf_weights') or [0.0] * len(tree['leaf_values'])
+        offset = len(builder.columns['feature'])
+        builder.roots.append(offset)
+        for level, split in enumerate(splits):
+            if split['split_type'] != 'FloatFeature':
+                raise ValueError("CatBoost split {} cannot be exported!!!".format(split['split_type']))
+            feature = float_features[split['float_feature_index']]
+            for _ in range(1 << level):
+                builder.add_node(feature=feature['flat_feature_index'], threshold=float(np.float32(split['border'])),
+                                 missing_left=feature.get('nan_value_treatment') not in ('AsTrue', 'Max'))
+        for position in range(1 << depth):
+            leaf = sum(((position >> (depth - 1 - level)) & 1) << level for level in range(depth))
+            builder.add_node(value=tree['leaf_values'][leaf], cover=leaf_weights[leaf])
+        for node in range((1 << depth) - 1):
+            builder.set_children(offset + node, offset + 2 * node + 1, offset + 2 * node + 2)
+    scale, bias = dump.get('scale_and_bias', [1.0, [0.0]])
+    bias = bias[0] if isinstance(bias, list) else bias
+    n_features = max((feature['flat_feature_index'] for feature in float_features.values()), default=-1) + 1
+    return TreeEnsemble(builder.get_arrays(), 'CB', 'le', post_scale=scale, post_bias=bias, n_features=n_features)
+
+
+exporters = {
+    'GradientBoostingRegressor': export_gradient_boosting,
+    'AdaBoostRegressor': export_adaboost,
+    'XGBRegressor': export_xgboost,
+    'LGBMRegressor': export_lightgbm,
+    'CatBoostRegressor': export_catboost,
+}
+
+
+def export_model(model):
+    kind = type(model).__name__
+    if kind not in exporters:
+        raise ValueError("{} cannot be exported to .npz!!!".format(kind))
+    return exporters[kind](model)
+
+
+def export_model_npz(model, file_path, rtol=1e-6):
+    # The export is checked against the model on random rows, on rows taken from the thresholds of the trees and,
+    # for models that accept them, on rows with missing values
+    ensemble = export_model(model)
+    rng = np.random.default_rng(0)
+    probe = rng.normal(scale=3.0, size=(4096, ensemble.n_features))
+    for feature in range(ensemble.n_features):
+        thresholds = ensemble.threshold[ensemble.feature == feature]
+        if len(thresholds) > 0:
+            probe[:2048, feature] = rng.choice(thresholds, size=2048)
+    probe = probe.astype(np.float32)
+    expected = np.asarray(model.predict(probe), dtype=np.float64)
+    # A missing value in every feature (feature 0 included) and in a few random features of other rows
+    missing_probe = probe[:1024].copy()
+    missing_probe[np.arange(len(missing_probe)), np.arange(len(missing_probe)) % ensemble.n_features] = np.nan
+    missing_probe[512:][rng.random((512, ensemble.n_features)) < 0.3] = np.nan
+    try:
+        expected = np.concatenate([expected, np.asarray(model.predict(missing_probe), dtype=np.float64)])
+        probe = np.concatenate([probe, missing_probe])
+    except ValueError:
+        # sklearn ensembles reject missing values
+        pass
+    results = ensemble.predict(probe).astype(np.float64)
+    if not np.allclose(results, expected, rtol=rtol, atol=rtol * max(1.0, np.abs(expected).max())):
+        raise ValueError("{} cannot be reproduced from .npz, largest difference {}!!!".format(
+            type(model).__name__, np.abs(results - expected).max()))
+    ensemble.save(file_path)
+    return ensemble
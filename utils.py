@@ -1,5 +1,5 @@
+import bisect
 import numpy as np
-import pandas as pd
 
 
 # Default parameters
@@ -31,6 +31,18 @@ RmT8 = ['PO4', 'DO', 'NO3', 'NO2', 'COD', 'NH4', 'Coliform', 'pH']
 RmT9 = ['BOD5', 'DO', 'NO3', 'NO2', 'COD', 'NH4', 'Coliform', 'pH'] # Same as SC8
 
 
+# Feature sets with trained models and scalers, named as in the model and scaler files
+feature_sets = {
+    'full': SC9, 'SC8': SC8, 'SC7': SC7, 'SC6': SC6, 'SC5': SC5, 'SC4': SC4, 'SC3': SC3, 'SC2': SC2,
+    'RmT3': RmT3, 'RmT4': RmT4, 'RmT5': RmT5, 'RmT6': RmT6, 'RmT7': RmT7, 'RmT8': RmT8,
+}
+
+# Feature set of each set of columns, RmT9 resolves to SC8 which has the same columns
+feature_set_index = {frozenset(columns): feature_set for feature_set, columns in feature_sets.items()}
+
+model_names = ['AB', 'CB', 'GB', 'LGB', 'XGB']
+
+
 ## Calibrate WQI based on Vietnam's standard
 # The current data include nine feature include: 'pH', 'DO' (including 'temperature'), 'COD', 'BOD5', 'PO4', 'NH4', 'NO2', 'NO3', and 'Coliform'
 # pH
@@ -62,445 +74,382 @@ BPi_Col_values = [2500, 5000, 7500, 10000]
 qi_Col_values = [100, 75, 50, 25]
 
 
-def check_variable_existence(data, variable_name):
-    return variable_name in data.columns
-
-
-def calculate_WQI_pH(pH_values):
-    WQI_pH_values = []
-
-    for pH_value in pH_values:
-        if pH_value < BPi_pH_values[0] or pH_value > BPi_pH_values[3]:
-            WQI_pH = 10
-        elif BPi_pH_values[0] <= pH_value < BPi_pH_values[1]:
-            BPi_pH = BPi_pH_values[0]
-            BPi_plus_1_pH = BPi_pH_values[1]
-            qi_pH = qi_pH_values[0]
-            qi_plus_1_pH = qi_pH_values[1]
-            WQI_pH = ((qi_plus_1_pH - qi_pH) / (BPi_plus_1_pH - BPi_pH)) * (pH_value - BPi_pH) + qi_pH
-        elif BPi_pH_values[1] <= pH_value <= BPi_pH_values[2]:
-            WQI_pH = 100
-        elif BPi_pH_values[2] < pH_value <= BPi_pH_values[3]:
-            BPi_pH = BPi_pH_values[2]
-            BPi_plus_1_pH = BPi_pH_values[3]
-            qi_pH = qi_pH_values[2]
-            qi_plus_1_pH = qi_pH_values[3]
-            WQI_pH = ((qi_pH - qi_plus_1_pH) / (BPi_plus_1_pH - BPi_pH)) * (BPi_plus_1_pH - pH_value) + qi_plus_1_pH
-        WQI_pH_values.append(WQI_pH)
-
-    return WQI_pH_values
-
-
-def calculate_WQI_DO(DO_percent, BPi_DO_values, qi_DO_values):
-    WQI_DO_values = []
-
-    for DO_value in DO_percent:
-        if DO_value <= 20 or DO_value >= 200:
-            WQI_DO = 10
-        elif 20 < DO_value < 50:
-            BPi_DO = BPi_DO_values[0]
-            BPi_plus_1_DO = BPi_DO_values[1]
-            qi_DO = qi_DO_values[0]
-            qi_plus_1_DO = qi_DO_values[1]
-            WQI_DO = ((qi_plus_1_DO - qi_DO) / (BPi_plus_1_DO - BPi_DO)) * (DO_value - BPi_DO) + qi_DO
-        elif 50 <= DO_value < 75:
-            BPi_DO = BPi_DO_values[1]
-            BPi_plus_1_DO = BPi_DO_values[2]
-            qi_DO = qi_DO_values[1]
-            qi_plus_1_DO = qi_DO_values[2]
-            WQI_DO = ((qi_plus_1_DO - qi_DO) / (BPi_plus_1_DO - BPi_DO)) * (DO_value - BPi_DO) + qi_DO
-        elif 75 <= DO_value < 88:
-            BPi_DO = BPi_DO_values[2]
-            BPi_plus_1_DO = BPi_DO_values[3]
-            qi_DO = qi_DO_values[2]
-            qi_plus_1_DO = qi_DO_values[3]
-            WQI_DO = ((qi_plus_1_DO - qi_DO) / (BPi_plus_1_DO - BPi_DO)) * (DO_value - BPi_DO) + qi_DO
-        elif 88 <= DO_value <= 112:
-            WQI_DO = 100
-        elif 112 < DO_value < 125:
-            BPi_DO = BPi_DO_values[3]
-            BPi_plus_1_DO = BPi_DO_values[4]
-            qi_DO = qi_DO_values[3]
-            qi_plus_1_DO = qi_DO_values[4]
-            WQI_DO = ((qi_DO - qi_plus_1_DO) / (BPi_plus_1_DO - BPi_DO)) * (BPi_plus_1_DO - DO_value) + qi_plus_1_DO
-        elif 125 <= DO_value < 150:
-            BPi_DO = BPi_DO_values[4]
-            BPi_plus_1_DO = BPi_DO_values[5]
-            qi_DO = qi_DO_values[4]
-            qi_plus_1_DO = qi_DO_values[5]
-            WQI_DO = ((qi_DO - qi_plus_1_DO) / (BPi_plus_1_DO - BPi_DO)) * (BPi_plus_1_DO - DO_value) + qi_plus_1_DO
-        elif 150 <= DO_value < 200:
-            BPi_DO = BPi_DO_values[5]
-            BPi_plus_1_DO = BPi_DO_values[6]
-            qi_DO = qi_DO_values[5]
-            qi_plus_1_DO = qi_DO_values[6]
-            WQI_DO = ((qi_DO - qi_plus_1_DO) / (BPi_plus_1_DO - BPi_DO)) * (BPi_plus_1_DO - DO_value) + qi_plus_1_DO
-        WQI_DO_values.append(WQI_DO)
-
-    return WQI_DO_values
+# Breakpoint tables of the sub-indices, compiled by compile_breakpoint_table
+# - scores: sub-index at each breakpoint, interpolated linearly in between
+# - closed: which segment owns a value lying exactly on a breakpoint ('left' for the segment ending there, 'right' for the one starting there)
+# - below/above: scores before the first and after the last breakpoint
+# - missing: score of NaN values
+VN_WQI_breakpoint_tables = {
+    'pH': dict(breakpoints=BPi_pH_values, scores=qi_pH_values,
+               closed=['right', 'right', 'left', 'left'], below=10, above=10, missing=np.nan),
+    # qi_DO_values lists the 88-112 plateau once
+    'DO': dict(breakpoints=BPi_DO_values, scores=qi_DO_values[:4] + qi_DO_values[3:],
+               closed=['left', 'right', 'right', 'right', 'left', 'right', 'right', 'right'], below=10, above=10, missing=np.nan),
+    'COD': dict(breakpoints=BPi_COD_values, scores=qi_COD_values,
+                closed=['left', 'right', 'right', 'right', 'right'], below=100, above=10, missing=10),
+    'BOD5': dict(breakpoints=BPi_BOD_values, scores=qi_BOD_values,
+                 closed=['left', 'right', 'right', 'right', 'right'], below=100, above=10, missing=10),
+    'PO4': dict(breakpoints=BPi_PO4_values, scores=qi_PO4_values,
+                closed=['left', 'right', 'right', 'right', 'right'], below=100, above=10, missing=10),
+    'NH4': dict(breakpoints=BPi_NH4_values, scores=qi_NH4_values,
+                closed=['right', 'right', 'right', 'right'], below=100, above=10, missing=10),
+    'NO2': dict(breakpoints=BPi_NO2_values, scores=qi_NO2_values[:1],
+                closed=['left'], below=qi_NO2_values[0], above=qi_NO2_values[1], missing=qi_NO2_values[1]),
+    # The first NO3 breakpoint is not used, the last segment goes down to 10 at 15
+    'NO3': dict(breakpoints=BPi_NO3_values[1:] + [15], scores=qi_NO3_values[:3] + [10],
+                closed=['left', 'right', 'right', 'left'], below=100, above=10, missing=10),
+    'Coliform': dict(breakpoints=BPi_Col_values, scores=qi_Col_values,
+                     closed=['left', 'right', 'right', 'right'], below=100, above=10, missing=10),
+}
+
+
+# Columns read by VN_WQI_Calculation
+VN_WQI_columns = ['pH', 'temperature', 'DO', 'COD', 'BOD5', 'PO4', 'NH4', 'NO2', 'NO3', 'Coliform']
+
+# VN WQI quality classes of Decision 1460/QD-TCMT, a WQI from the lower bound up to the next one is in the class
+VN_WQI_class_lower_bounds = [10, 26, 51, 76, 91]
+VN_WQI_class_names = ['Very bad', 'Bad', 'Poor', 'Medium', 'Good', 'Excellent']
+
+
+def get_VN_WQI_class(VN_WQI_values):
+    # Index of the quality class in VN_WQI_class_names, -1 for missing values
+    VN_WQI_values = to_float_array(VN_WQI_values)[0]
+    classes = np.searchsorted(VN_WQI_class_lower_bounds, VN_WQI_values, side='right')
+    return np.where(np.isnan(VN_WQI_values), -1, classes)
 
 
-def calculate_WQI_COD(COD_values):
-    WQI_COD_values = []
-
-    for COD_value in COD_values:
-        if COD_value <= BPi_COD_values[0]:
-            WQI_COD = 100
-        elif BPi_COD_values[0] < COD_value < BPi_COD_values[1]:
-            BPi_COD = BPi_COD_values[0]
-            BPi_plus_1_COD = BPi_COD_values[1]
-            qi_COD = qi_COD_values[0]
-            qi_plus_1_COD = qi_COD_values[1]
-            WQI_COD = ((qi_COD - qi_plus_1_COD) / (BPi_plus_1_COD - BPi_COD)) * (
-                        BPi_plus_1_COD - COD_value) + qi_plus_1_COD
-        elif BPi_COD_values[1] <= COD_value < BPi_COD_values[2]:
-            BPi_COD = BPi_COD_values[1]
-            BPi_plus_1_COD = BPi_COD_values[2]
-            qi_COD = qi_COD_values[1]
-            qi_plus_1_COD = qi_COD_values[2]
-            WQI_COD = ((qi_COD - qi_plus_1_COD) / (BPi_plus_1_COD - BPi_COD)) * (
-                        BPi_plus_1_COD - COD_value) + qi_plus_1_COD
-        elif BPi_COD_values[2] <= COD_value < BPi_COD_values[3]:
-            BPi_COD = BPi_COD_values[2]
-            BPi_plus_1_COD = BPi_COD_values[3]
-            qi_COD = qi_COD_values[2]
-            qi_plus_1_COD = qi_COD_values[3]
-            WQI_COD = ((qi_COD - qi_plus_1_COD) / (BPi_plus_1_COD - BPi_COD)) * (
-                        BPi_plus_1_COD - COD_value) + qi_plus_1_COD
-        elif BPi_COD_values[3] <= COD_value < BPi_COD_values[4]:
-            BPi_COD = BPi_COD_values[3]
-            BPi_plus_1_COD = BPi_COD_values[4]
-            qi_COD = qi_COD_values[3]
-            qi_plus_1_COD = qi_COD_values[4]
-            WQI_COD = ((qi_COD - qi_plus_1_COD) / (BPi_plus_1_COD - BPi_COD)) * (
-                        BPi_plus_1_COD - COD_value) + qi_plus_1_COD
+def check_variable_existence(data, variable_name):
+    # data is a DataFrame or a dict of column arrays
+    return variable_name in (data.columns if hasattr(data, 'columns') else data)
+
+
+def compile_breakpoint_table(breakpoints, scores, closed, below, above, missing=None):
+    # Segment k lies between breakpoints[k - 1] and breakpoints[k], segments 0 and len(breakpoints) are the tails
+    if len(breakpoints) != len(scores) or len(breakpoints) != len(closed):
+        raise ValueError("breakpoints, scores and closed must have the same length")
+    if any(lower >= upper for lower, upper in zip(breakpoints, breakpoints[1:])):
+        raise ValueError("breakpoints must be strictly increasing")
+    if any(side not in ('left', 'right') for side in closed):
+        raise ValueError("closed must contain only 'left' or 'right'")
+
+    n_segments = len(breakpoints) + 1
+    anchor_x = np.zeros(n_segments)
+    anchor_q = np.zeros(n_segments)
+    slope = np.zeros(n_segments)
+    direction = np.ones(n_segments)
+    constant = np.ones(n_segments, dtype=bool)
+    anchor_q[0] = below
+    anchor_q[-1] = above
+    for k in range(1, n_segments - 1):
+        BPi, BPi_plus_1 = breakpoints[k - 1], breakpoints[k]
+        qi, qi_plus_1 = scores[k - 1], scores[k]
+        # Interpolate from the lower score, like the per-branch formulas of the standard
+        if qi_plus_1 > qi:
+            slope[k] = (qi_plus_1 - qi) / (BPi_plus_1 - BPi)
+            anchor_x[k], anchor_q[k] = BPi, qi
+            constant[k] = False
+        elif qi_plus_1 < qi:
+            slope[k] = (qi - qi_plus_1) / (BPi_plus_1 - BPi)
+            anchor_x[k], anchor_q[k], direction[k] = BPi_plus_1, qi_plus_1, -1
+            constant[k] = False
         else:
-            WQI_COD = 10
+            anchor_q[k] = qi
 
-        WQI_COD_values.append(WQI_COD)
+    return {
+        'breakpoints': np.asarray(breakpoints, dtype=np.float64),
+        'left_closed': np.array([side == 'left' for side in closed], dtype=bool),
+        'anchor_x': anchor_x,
+        'anchor_q': anchor_q,
+        'slope': slope,
+        'direction': direction,
+        'constant': constant,
+        'missing': above if missing is None else missing,
+    }
 
-    return WQI_COD_values
 
+def to_float_array(values):
+    # None entries are kept apart from NaN: they have no sub-index at all
+    values = np.asarray(values)
+    if values.dtype == object:
+        none_mask = np.array([value is None for value in values], dtype=bool)
+        values = np.where(none_mask, np.nan, values).astype(np.float64)
+        return values, none_mask
+    return values.astype(np.float64), None
 
-def calculate_WQI_BOD(BOD_values, BPi_BOD_values, qi_BOD_values):
-    WQI_BOD_values = []
-
-    for BOD_value in BOD_values:
-        if BOD_value <= BPi_BOD_values[0]:
-            WQI_BOD = 100
-        elif BPi_BOD_values[0] < BOD_value < BPi_BOD_values[1]:
-            BPi_BOD = BPi_BOD_values[0]
-            BPi_plus_1_BOD = BPi_BOD_values[1]
-            qi_BOD = qi_BOD_values[0]
-            qi_plus_1_BOD = qi_BOD_values[1]
-            WQI_BOD = ((qi_BOD - qi_plus_1_BOD) / (BPi_plus_1_BOD - BPi_BOD)) * (
-                        BPi_plus_1_BOD - BOD_value) + qi_plus_1_BOD
-        elif BPi_BOD_values[1] <= BOD_value < BPi_BOD_values[2]:
-            BPi_BOD = BPi_BOD_values[1]
-            BPi_plus_1_BOD = BPi_BOD_values[2]
-            qi_BOD = qi_BOD_values[1]
-            qi_plus_1_BOD = qi_BOD_values[2]
-            WQI_BOD = ((qi_BOD - qi_plus_1_BOD) / (BPi_plus_1_BOD - BPi_BOD)) * (
-                        BPi_plus_1_BOD - BOD_value) + qi_plus_1_BOD
-        elif BPi_BOD_values[2] <= BOD_value < BPi_BOD_values[3]:
-            BPi_BOD = BPi_BOD_values[2]
-            BPi_plus_1_BOD = BPi_BOD_values[3]
-            qi_BOD = qi_BOD_values[2]
-            qi_plus_1_BOD = qi_BOD_values[3]
-            WQI_BOD = ((qi_BOD - qi_plus_1_BOD) / (BPi_plus_1_BOD - BPi_BOD)) * (
-                        BPi_plus_1_BOD - BOD_value) + qi_plus_1_BOD
-        elif BPi_BOD_values[3] <= BOD_value < BPi_BOD_values[4]:
-            BPi_BOD = BPi_BOD_values[3]
-            BPi_plus_1_BOD = BPi_BOD_values[4]
-            qi_BOD = qi_BOD_values[3]
-            qi_plus_1_BOD = qi_BOD_values[4]
-            WQI_BOD = ((qi_BOD - qi_plus_1_BOD) / (BPi_plus_1_BOD - BPi_BOD)) * (
-                        BPi_plus_1_BOD - BOD_value) + qi_plus_1_BOD
-        else:
-            WQI_BOD = 10
-
-        WQI_BOD_values.append(WQI_BOD)
 
-    return WQI_BOD_values
+def evaluate_breakpoint_table(values, table):
+    values, none_mask = to_float_array(values)
+    breakpoints = table['breakpoints']
 
+    # Binary search for the segment, then move values lying on a left-closed breakpoint one segment down
+    segment = np.searchsorted(breakpoints, values, side='right')
+    previous = np.maximum(segment - 1, 0)
+    segment -= (segment > 0) & table['left_closed'][previous] & (breakpoints[previous] == values)
 
-def calculate_WQI_PO4(PO4_values):
-    WQI_PO4_values = []
-
-    for PO4_value in PO4_values:
-        if PO4_value is not None:  # Check if PO4_value exists and is not None
-            if PO4_value <= BPi_PO4_values[0]:
-                WQI_PO4 = 100
-            elif BPi_PO4_values[0] < PO4_value < BPi_PO4_values[1]:
-                BPi_PO4 = BPi_PO4_values[0]
-                BPi_plus_1_PO4 = BPi_PO4_values[1]
-                qi_PO4 = qi_PO4_values[0]
-                qi_plus_1_PO4 = qi_PO4_values[1]
-                WQI_PO4 = ((qi_PO4 - qi_plus_1_PO4) / (BPi_plus_1_PO4 - BPi_PO4)) * (BPi_plus_1_PO4 - PO4_value) + qi_plus_1_PO4
-            elif BPi_PO4_values[1] <= PO4_value < BPi_PO4_values[2]:
-                BPi_PO4 = BPi_PO4_values[1]
-                BPi_plus_1_PO4 = BPi_PO4_values[2]
-                qi_PO4 = qi_PO4_values[1]
-                qi_plus_1_PO4 = qi_PO4_values[2]
-                WQI_PO4 = ((qi_PO4 - qi_plus_1_PO4) / (BPi_plus_1_PO4 - BPi_PO4)) * (BPi_plus_1_PO4 - PO4_value) + qi_plus_1_PO4
-            elif BPi_PO4_values[2] <= PO4_value < BPi_PO4_values[3]:
-                BPi_PO4 = BPi_PO4_values[2]
-                BPi_plus_1_PO4 = BPi_PO4_values[3]
-                qi_PO4 = qi_PO4_values[2]
-                qi_plus_1_PO4 = qi_PO4_values[3]
-                WQI_PO4 = ((qi_PO4 - qi_plus_1_PO4) / (BPi_plus_1_PO4 - BPi_PO4)) * (BPi_plus_1_PO4 - PO4_value) + qi_plus_1_PO4
-            elif BPi_PO4_values[3] <= PO4_value < BPi_PO4_values[4]:
-                BPi_PO4 = BPi_PO4_values[3]
-                BPi_plus_1_PO4 = BPi_PO4_values[4]
-                qi_PO4 = qi_PO4_values[3]
-                qi_plus_1_PO4 = qi_PO4_values[4]
-                WQI_PO4 = ((qi_PO4 - qi_plus_1_PO4) / (BPi_plus_1_PO4 - BPi_PO4)) * (BPi_plus_1_PO4 - PO4_value) + qi_plus_1_PO4
-            else:
-                WQI_PO4 = 10  # Out of range value
+    with np.errstate(invalid='ignore'):
+        WQI_values = table['slope'][segment] * (table['direction'][segment] * (values - table['anchor_x'][segment])) + table['anchor_q'][segment]
+    WQI_values = np.where(table['constant'][segment], table['anchor_q'][segment], WQI_values)
+    WQI_values[np.isnan(values)] = table['missing']
+    if none_mask is not None:
+        WQI_values[none_mask] = np.nan
 
-        else:
-            WQI_PO4 = None  # PO4_value is None
+    return WQI_values
 
-        WQI_PO4_values.append(WQI_PO4)
 
-    return WQI_PO4_values
+VN_WQI_tables = {name: compile_breakpoint_table(**spec) for name, spec in VN_WQI_breakpoint_tables.items()}
 
 
-def calculate_WQI_NH4(NH4_values):
-    WQI_NH4_values = []
-
-    for NH4_value in NH4_values:
-        if NH4_value is not None:  # Check if NH4_value exists
-            if NH4_value < BPi_NH4_values[0]:
-                WQI_NH4 = 100
-            elif BPi_NH4_values[0] <= NH4_value < BPi_NH4_values[1]:
-                BPi_NH4 = BPi_NH4_values[0]
-                BPi_plus_1_NH4 = BPi_NH4_values[1]
-                qi_NH4 = qi_NH4_values[0]
-                qi_plus_1_NH4 = qi_NH4_values[1]
-                WQI_NH4 = ((qi_NH4 - qi_plus_1_NH4) / (BPi_plus_1_NH4 - BPi_NH4)) * (BPi_plus_1_NH4 - NH4_value) + qi_plus_1_NH4
-            elif BPi_NH4_values[1] <= NH4_value < BPi_NH4_values[2]:
-                BPi_NH4 = BPi_NH4_values[1]
-                BPi_plus_1_NH4 = BPi_NH4_values[2]
-                qi_NH4 = qi_NH4_values[1]
-                qi_plus_1_NH4 = qi_NH4_values[2]
-                WQI_NH4 = ((qi_NH4 - qi_plus_1_NH4) / (BPi_plus_1_NH4 - BPi_NH4)) * (BPi_plus_1_NH4 - NH4_value) + qi_plus_1_NH4
-            elif BPi_NH4_values[2] <= NH4_value < BPi_NH4_values[3]:
-                BPi_NH4 = BPi_NH4_values[2]
-                BPi_plus_1_NH4 = BPi_NH4_values[3]
-                qi_NH4 = qi_NH4_values[2]
-                qi_plus_1_NH4 = qi_NH4_values[3]
-                WQI_NH4 = ((qi_NH4 - qi_plus_1_NH4) / (BPi_plus_1_NH4 - BPi_NH4)) * (BPi_plus_1_NH4 - NH4_value) + qi_plus_1_NH4
-            else:
-                WQI_NH4 = 10
-        else:
-            WQI_NH4 = None  # NH4_value does not exist
-
-        WQI_NH4_values.append(WQI_NH4)
+def calculate_WQI_pH(pH_values):
+    return evaluate_breakpoint_table(pH_values, VN_WQI_tables['pH'])
 
-    return WQI_NH4_values
 
+def calculate_WQI_DO(DO_percent, BPi_DO_values, qi_DO_values):
+    table = compile_breakpoint_table(**dict(VN_WQI_breakpoint_tables['DO'], breakpoints=BPi_DO_values, scores=qi_DO_values[:4] + qi_DO_values[3:]))
+    return evaluate_breakpoint_table(DO_percent, table)
 
-def calculate_WQI_NO2(NO2_values):
-    WQI_NO2_values = []
-
-    for NO2_value in NO2_values:
-        if NO2_value is not None:  # Check if NO2_value exists
-            if NO2_value <= BPi_NO2_values[0]:
-                WQI_NO2 = qi_NO2_values[0]
-            else:
-                WQI_NO2 = qi_NO2_values[1]
-        else:
-            WQI_NO2 = None  # NO2_value does not exist
 
-        WQI_NO2_values.append(WQI_NO2)
+def calculate_WQI_COD(COD_values):
+    return evaluate_breakpoint_table(COD_values, VN_WQI_tables['COD'])
 
-    return WQI_NO2_values
 
+def calculate_WQI_BOD(BOD_values, BPi_BOD_values, qi_BOD_values):
+    table = compile_breakpoint_table(**dict(VN_WQI_breakpoint_tables['BOD5'], breakpoints=BPi_BOD_values, scores=qi_BOD_values))
+    return evaluate_breakpoint_table(BOD_values, table)
 
-def calculate_WQI_NO3(NO3_values):
-    WQI_NO3_values = []
-
-    for NO3_value in NO3_values:
-        if NO3_value is not None:
-            if NO3_value <= 2:
-                WQI_NO3 = 100
-            elif 2 < NO3_value < 5:
-                BPi_NO3 = BPi_NO3_values[1]
-                BPi_plus_1_NO3 = BPi_NO3_values[2]
-                qi_NO3 = qi_NO3_values[0]
-                qi_plus_1_NO3 = qi_NO3_values[1]
-                WQI_NO3 = ((qi_NO3 - qi_plus_1_NO3) / (BPi_plus_1_NO3 - BPi_NO3)) * (BPi_plus_1_NO3 - NO3_value) + qi_plus_1_NO3
-            elif 5 <= NO3_value < 10:
-                BPi_NO3 = BPi_NO3_values[2]
-                BPi_plus_1_NO3 = BPi_NO3_values[3]
-                qi_NO3 = qi_NO3_values[1]
-                qi_plus_1_NO3 = qi_NO3_values[2]
-                WQI_NO3 = ((qi_NO3 - qi_plus_1_NO3) / (BPi_plus_1_NO3 - BPi_NO3)) * (BPi_plus_1_NO3 - NO3_value) + qi_plus_1_NO3
-            elif 10 <= NO3_value <= 15:
-                BPi_NO3 = BPi_NO3_values[3]
-                BPi_plus_1_NO3 = 15
-                qi_NO3 = qi_NO3_values[2]
-                qi_plus_1_NO3 = 10
-                WQI_NO3 = ((qi_NO3 - qi_plus_1_NO3) / (BPi_plus_1_NO3 - BPi_NO3)) * (BPi_plus_1_NO3 - NO3_value) + qi_plus_1_NO3
-            else:
-                WQI_NO3 = 10
-        else:
-            WQI_NO3 = None
 
-        WQI_NO3_values.append(WQI_NO3)
+def calculate_WQI_PO4(PO4_values):
+    return evaluate_breakpoint_table(PO4_values, VN_WQI_tables['PO4'])
 
-    return WQI_NO3_values
 
+def calculate_WQI_NH4(NH4_values):
+    return evaluate_breakpoint_table(NH4_values, VN_WQI_tables['NH4'])
 
-def calculate_WQI_Col(Coliform_values):
-    WQI_Col_values = []
-
-    for Col_value in Coliform_values:
-        if Col_value is not None:
-            if Col_value <= BPi_Col_values[0]:
-                WQI_Col = 100
-
-            elif BPi_Col_values[0] < Col_value < BPi_Col_values[1]:
-                BPi_Col = BPi_Col_values[0]
-                qi_Col = qi_Col_values[0]
-                qi_plus_1_Col = qi_Col_values[1]
-                WQI_Col = ((qi_Col - qi_plus_1_Col) / (BPi_Col_values[1] - BPi_Col)) * (BPi_Col_values[1] - Col_value) + qi_plus_1_Col
-
-            elif BPi_Col_values[1] <= Col_value < BPi_Col_values[2]:
-                BPi_Col = BPi_Col_values[1]
-                qi_Col = qi_Col_values[1]
-                qi_plus_1_Col = qi_Col_values[2]
-                WQI_Col = ((qi_Col - qi_plus_1_Col) / (BPi_Col_values[2] - BPi_Col)) * (BPi_Col_values[2] - Col_value) + qi_plus_1_Col
-
-            elif BPi_Col_values[2] <= Col_value < BPi_Col_values[3]:
-                BPi_Col = BPi_Col_values[2]
-                qi_Col = qi_Col_values[2]
-                qi_plus_1_Col = qi_Col_values[3]
-                WQI_Col = ((qi_Col - qi_plus_1_Col) / (BPi_Col_values[3] - BPi_Col)) * (BPi_Col_values[3] - Col_value) + qi_plus_1_Col
-
-            else:
-                WQI_Col = 10
 
-        else:
-            WQI_Col = None
+def calculate_WQI_NO2(NO2_values):
+    return evaluate_breakpoint_table(NO2_values, VN_WQI_tables['NO2'])
 
-        WQI_Col_values.append(WQI_Col)
 
-    return WQI_Col_values
+def calculate_WQI_NO3(NO3_values):
+    return evaluate_breakpoint_table(NO3_values, VN_WQI_tables['NO3'])
 
 
-def VN_WQI_Calculation(original_data_path):
+def calculate_WQI_Col(Coliform_values):
+    return evaluate_breakpoint_table(Coliform_values, VN_WQI_tables['Coliform'])
+
+
+def VN_WQI_Calculation(original_data_path, n_jobs=None, chunksize=None, metadata_columns=None):
+    # With metadata_columns (e.g. metadata), a DataFrame of these columns and VN_WQI is returned instead of a list
+    import pandas as pd
+    if n_jobs is None and chunksize is None:
+        non_Vietnamese_standard_data = pd.read_csv(original_data_path, usecols=get_VN_WQI_usecols(metadata_columns))
+        VN_WQI = calculate_VN_WQI(non_Vietnamese_standard_data)
+        if metadata_columns is None:
+            return VN_WQI
+        return add_metadata(VN_WQI, [get_metadata(non_Vietnamese_standard_data, metadata_columns)], metadata_columns)
+    # chunksize alone shards the file in the calling process, only a given n_jobs starts processes
+    return VN_WQI_Calculation_sharded(original_data_path, n_jobs or 1, chunksize or 100000, metadata_columns)
+
+
+def get_VN_WQI_usecols(metadata_columns=None):
+    columns = VN_WQI_columns + list(metadata_columns or [])
+    return lambda col: col in columns
+
+
+def get_metadata(shard, metadata_columns):
+    # Only the metadata columns of a shard are kept, the measurements are not copied
+    missing_columns = [col for col in metadata_columns if col not in shard.columns]
+    if missing_columns:
+        raise ValueError("{} are not in the data!!!".format(missing_columns))
+    return shard[metadata_columns]
+
+
+def add_metadata(VN_WQI, shard_metadata, metadata_columns=None):
+    if metadata_columns is None:
+        return VN_WQI
+    import pandas as pd
+    data = pd.concat(shard_metadata, ignore_index=True) if shard_metadata else pd.DataFrame(columns=metadata_columns)
+    data['VN_WQI'] = np.asarray(VN_WQI, dtype=np.float64)
+    return data
+
+
+def VN_WQI_Calculation_sharded(original_data_path, n_jobs=None, chunksize=100000, metadata_columns=None):
+    # The CSV is read in shards of chunksize rows, which are scored by n_jobs processes and concatenated in order.
+    # At most two shards per process are read ahead, so memory does not grow with the file size.
+    import pandas as pd
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+    n_jobs = n_jobs or os.cpu_count() or 1
+    shards = pd.read_csv(original_data_path, usecols=get_VN_WQI_usecols(metadata_columns), chunksize=chunksize)
     VN_WQI = []
-    data = pd.DataFrame()
-    non_Vietnamese_standard_data = pd.read_csv(original_data_path)
+    # Metadata of every shard, kept in the calling process
+    shard_metadata = []
+    first_shard = next(shards, None)
+    if first_shard is None:
+        return add_metadata(VN_WQI, shard_metadata, metadata_columns)
+    # Missing variables are reported once, not once per shard
+    VN_WQI.extend(calculate_VN_WQI(first_shard))
+    if metadata_columns is not None:
+        shard_metadata.append(get_metadata(first_shard, metadata_columns))
+    if n_jobs == 1:
+        for shard in shards:
+            VN_WQI.extend(calculate_VN_WQI(shard, verbose=False))
+            if metadata_columns is not None:
+                shard_metadata.append(get_metadata(shard, metadata_columns))
+        return add_metadata(VN_WQI, shard_metadata, metadata_columns)
+    with ProcessPoolExecutor(n_jobs) as executor:
+        pending = deque()
+        for shard in shards:
+            pending.append(executor.submit(calculate_VN_WQI, shard, False))
+            if metadata_columns is not None:
+                shard_metadata.append(get_metadata(shard, metadata_columns))
+            if len(pending) >= 2 * n_jobs:
+                VN_WQI.extend(pending.popleft().result())
+        while pending:
+            VN_WQI.extend(pending.popleft().result())
+    return add_metadata(VN_WQI, shard_metadata, metadata_columns)
+
+
+def calculate_VN_WQI(non_Vietnamese_standard_data, verbose=True):
+    # VN WQI of every row of a DataFrame (or a dict of column arrays) of raw measurements
+    n_rows = len(non_Vietnamese_standard_data) if hasattr(non_Vietnamese_standard_data, 'columns') else \
+        len(next(iter(non_Vietnamese_standard_data.values()), []))
+    # Sub-indices of the parameters present
+    data = {}
     if check_variable_existence(non_Vietnamese_standard_data, 'pH'):
         pH_values = non_Vietnamese_standard_data['pH']
         WQI_pH_values = calculate_WQI_pH(pH_values)
         data['WQI_pH'] = WQI_pH_values
-    else:
+    elif verbose:
         print("Variable 'pH' does not exist in DataFrame. Skip calculating WQI_pH")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'temperature'):
         T_list = non_Vietnamese_standard_data['temperature']
         DO_actual = non_Vietnamese_standard_data['DO']  # Assuming DO_actual is the correct name for measured DO
 
-        DO_saturation_list = []
-
-        for T in T_list:
-            DO_saturation = 14.652 - 0.41022 * T + 0.0079910 * T ** 2 - 0.000077774 * T ** 3
-            DO_saturation_list.append(DO_saturation)
-
-        def calculated_DO_percent_saturation(DO_saturation_list, DO_actual):
-            DO_percent_value = []
-            for DO_sat, DO_val in zip(DO_saturation_list, DO_actual):
-                DO_percent_saturation = (DO_val / DO_sat) * 100
-                DO_percent_value.append(DO_percent_saturation)
-            return DO_percent_value
-
-        DO_percent = calculated_DO_percent_saturation(DO_saturation_list, DO_actual)
+        T_list = np.asarray(T_list, dtype=np.float64)
+        DO_saturation = 14.652 - 0.41022 * T_list + 0.0079910 * T_list ** 2 - 0.000077774 * T_list ** 3
+        DO_percent = (np.asarray(DO_actual, dtype=np.float64) / DO_saturation) * 100
 
         # Calculate WQI_DO based on DO_percent and constants
         WQI_DO_values = calculate_WQI_DO(DO_percent, BPi_DO_values, qi_DO_values)
 
         # Add 'WQI_DO' column to the DataFrame
         data['WQI_DO'] = WQI_DO_values
-    else:
+    elif verbose:
         print("The 'temperature' column is not present in the data. Skipping DO calculations.")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'COD'):
         COD_values = non_Vietnamese_standard_data['COD']
         WQI_COD_values = calculate_WQI_COD(COD_values)
         data['WQI_COD'] = WQI_COD_values
-    else:
+    elif verbose:
         print("Variable 'COD' does not exist in DataFrame. Skip calculating WQI_COD")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'BOD5'):
         BOD_values = non_Vietnamese_standard_data['BOD5']
         WQI_BOD_values = calculate_WQI_BOD(BOD_values, BPi_BOD_values, qi_BOD_values)
         data['WQI_BOD'] = WQI_BOD_values
-    else:
+    elif verbose:
         print("Variable 'BOD5' does not exist in DataFrame. Skipping WQI_BOD calculation.")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'PO4'):
         WQI_PO4_values = calculate_WQI_PO4(non_Vietnamese_standard_data['PO4'])
         data['WQI_PO4'] = WQI_PO4_values
-    else:
+    elif verbose:
         print("The variable 'PO4' does not exist in the DataFrame. Aborting calculation of WQI_PO4")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'NH4'):
-        WQI_NH4_values = calculate_WQI_PO4(non_Vietnamese_standard_data['NH4'])
+        WQI_NH4_values = calculate_WQI_NH4(non_Vietnamese_standard_data['NH4'])
         data['WQI_NH4'] = WQI_NH4_values
-    else:
+    elif verbose:
         print("The variable 'NH4' does not exist in the DataFrame. Aborting calculation of WQI_NH4")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'NO2'):
         WQI_NO2_values = calculate_WQI_NO2(non_Vietnamese_standard_data['NO2'])
         data['WQI_NO2'] = WQI_NO2_values
-    else:
+    elif verbose:
         print("The variable 'NO2' does not exist in the DataFrame. Skip calculating WQI_NO2.")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'NO3'):
         NO3_values = non_Vietnamese_standard_data['NO3']
         WQI_NO3_values = calculate_WQI_NO3(NO3_values)
         data['WQI_NO3'] = WQI_NO3_values
-    else:
+    elif verbose:
         print("Variable 'NO3' does not exist in the DataFrame. Skip calculating WQI_NO3.")
 
     if check_variable_existence(non_Vietnamese_standard_data, 'Coliform'):
         Coliform_values = non_Vietnamese_standard_data['Coliform']
         WQI_Col_values = calculate_WQI_Col(Coliform_values)
         data['WQI_Col'] = WQI_Col_values
-    else:
+    elif verbose:
         print("Variable 'Coliform' does not exist in the DataFrame. Skip calculating WQI_Col.")
 
-    for _, row in data.iterrows():
-        # Check the existence of variables and assign values if any
-        pH = row['WQI_pH'] if 'WQI_pH' in row else None
-        DO = row['WQI_DO'] if 'WQI_DO' in row else None
-        BOD5 = row['WQI_BOD'] if 'WQI_BOD' in row else None
-        COD = row['WQI_COD'] if 'WQI_COD' in row else None
-        NH4 = row['WQI_NH4'] if 'WQI_NH4' in row else None
-        NO3 = row['WQI_NO3'] if 'WQI_NO3' in row else None
-        NO2 = row['WQI_NO2'] if 'WQI_NO2' in row else None
-        PO4 = row['WQI_PO4'] if 'WQI_PO4' in row else None
-        Col = row['WQI_Col'] if 'WQI_Col' in row else None
-
-        # Create a list of available values (not None)
-        values = [val for val in [DO, BOD5, COD, NH4, NO3, NO2, PO4] if val is not None]
-
-        # If there is no value, skip this line
-        if len(values) == 0:
-            VN_WQI.append(None)
-            continue
-
-        # Calculate individual WQI components if sufficient data is available
-        WQI_1 = pH / 100 if pH is not None else 1  # Default value if pH is not available
-        WQI_4 = (sum(values) / len(values)) ** 2
-        WQI_5 = Col if Col is not None else 1  # Default value if Colìorm is not present
-
-        # Calculate total WQI using the formula provided
-        WQI = round(WQI_1 * (WQI_4 * WQI_5) ** (1 / 3), 2)
-        VN_WQI.append(WQI)
-
-    return VN_WQI
\ No newline at end of file
+    # Check the existence of variables and assign values if any
+    pH = data['WQI_pH'] if 'WQI_pH' in data else None
+    Col = data['WQI_Col'] if 'WQI_Col' in data else None
+    values = [data[col] for col in ['WQI_DO', 'WQI_BOD', 'WQI_COD', 'WQI_NH4', 'WQI_NO3', 'WQI_NO2', 'WQI_PO4'] if col in data]
+
+    # If there is no value, skip these lines
+    if len(values) == 0:
+        return [None] * n_rows
+
+    # Calculate individual WQI components if sufficient data is available
+    WQI_1 = pH / 100 if pH is not None else 1  # Default value if pH is not available
+    WQI_4 = values[0]
+    for value in values[1:]:
+        WQI_4 = WQI_4 + value
+    WQI_4 = (WQI_4 / len(values)) ** 2
+    WQI_5 = Col if Col is not None else 1  # Default value if Colìorm is not present
+
+    # Calculate total WQI using the formula provided
+    WQI = WQI_1 * (WQI_4 * WQI_5) ** (1 / 3)
+    VN_WQI = np.round(WQI, 2)
+    # np.round can only disagree with Python's round() next to a tie, redo those with round()
+    scaled = WQI * 100
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    VN_WQI[near_tie] = [round(value, 2) for value in WQI[near_tie].tolist()]
+
+    return VN_WQI.tolist()
+
+
+# Per-record VN WQI for live readings, the tables are evaluated with bisect on plain lists instead of NumPy arrays
+VN_WQI_scalar_tables = {name: {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in table.items()}
+                        for name, table in VN_WQI_tables.items()}
+
+
+def evaluate_breakpoint_table_scalar(value, table):
+    # Same segments and arithmetic as evaluate_breakpoint_table for a single float
+    if value != value:
+        return table['missing']
+    breakpoints = table['breakpoints']
+    segment = bisect.bisect_right(breakpoints, value)
+    if segment > 0 and table['left_closed'][segment - 1] and breakpoints[segment - 1] == value:
+        segment -= 1
+    if table['constant'][segment]:
+        return table['anchor_q'][segment]
+    return table['slope'][segment] * (table['direction'][segment] * (value - table['anchor_x'][segment])) + table['anchor_q'][segment]
+
+
+def calculate_VN_WQI_record(record):
+    # VN WQI of one reading given as a dict, a parameter missing from the dict is skipped like a missing column
+    # and a None value is treated like an empty CSV cell
+    get = lambda name: float('nan') if record[name] is None else float(record[name])
+    tables = VN_WQI_scalar_tables
+    values = []
+    if 'temperature' in record:
+        T = get('temperature')
+        DO_saturation = 14.652 - 0.41022 * T + 0.0079910 * T ** 2 - 0.000077774 * T ** 3
+        values.append(evaluate_breakpoint_table_scalar(get('DO') / DO_saturation * 100 if DO_saturation != 0 else float('nan'), tables['DO']))
+    for name in ['BOD5', 'COD', 'NH4', 'NO3', 'NO2', 'PO4']:
+        if name in record:
+            values.append(evaluate_breakpoint_table_scalar(get(name), tables[name]))
+    if len(values) == 0:
+        return None
+    WQI_1 = evaluate_breakpoint_table_scalar(get('pH'), tables['pH']) / 100 if 'pH' in record else 1
+    WQI_4 = values[0]
+    for value in values[1:]:
+        WQI_4 = WQI_4 + value
+    WQI_4 = (WQI_4 / len(values)) ** 2
+    WQI_5 = evaluate_breakpoint_table_scalar(get('Coliform'), tables['Coliform']) if 'Coliform' in record else 1
+    return round(WQI_1 * (WQI_4 * WQI_5) ** (1 / 3), 2)